@@ -0,0 +1,112 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class TTLCache(object):
+    """Thread safe, process local cache of at most ``maxsize`` items that
+    expire ``ttl`` seconds after they are set, least recently used items
+    being evicted first.
+    """
+
+    def __init__(self, maxsize=128, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.pop(key, MISSING)
+            if item is MISSING:
+                return default
+            expires, value = item
+            if expires < time.time():
+                return default
+            # move it to the most recently used end
+            self._items[key] = item
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (time.time() + ttl, value)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class ResponseCache(object):
+    """Cache of API responses in files under ``path``, shared between runs.
+
+    Entries are addressed by a hash of the query parameters. Those stored
+    with ``ttl=None`` never expire; the others are ignored ``ttl`` seconds
+    after they were stored. Files are written to a temporary name and
+    renamed into place, so concurrent readers and writers never see a
+    partial entry.
+    """
+
+    def __init__(self, path, ttl=3600):
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, params):
+        return hashlib.sha1(json.dumps(params, sort_keys=True)).hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.path, key[:2], key + '.json')
+
+    def get(self, params, default=None):
+        try:
+            with open(self._filename(self.key(params))) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            self.misses += 1
+            return default
+        if entry['expires'] is not None and entry['expires'] < time.time():
+            self.misses += 1
+            return default
+        self.hits += 1
+        return entry['response']
+
+    def set(self, params, response, ttl=MISSING):
+        if ttl is MISSING:
+            ttl = self.ttl
+        if ttl is not None and ttl <= 0:
+            return
+        filename = self._filename(self.key(params))
+        directory = os.path.dirname(filename)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created by another thread in the meantime
+                if not os.path.isdir(directory):
+                    raise
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'params': params,
+                           'expires': None if ttl is None
+                           else time.time() + ttl,
+                           'response': response}, f)
+            os.rename(tmp, filename)
+        except:
+            os.remove(tmp)
+            raise
@@ -1,14 +1,21 @@
 import os
 import re
+import sys
 import logging
 import datetime
-import time
+import itertools
+import threading
+import Queue
+from multiprocessing.pool import ThreadPool
 
 from pylons import config as pylonsconfig
 from ckan.lib.cli import CkanCommand
 import ckan.model as model
 
 import dbutil
+from dbutil import PACKAGE_NOT_FOUND
+from cache import ResponseCache
+from ratelimit import RateLimiter
 
 log = logging.getLogger('ckanext.googleanalytics')
 PACKAGE_URL = '/dataset/'  # XXX get from routes...
@@ -16,6 +23,57 @@ DEFAULT_RESOURCE_URL_TAG = '/downloads/'
 
 RESOURCE_URL_REGEX = re.compile('/dataset/[a-z0-9-_]+/resource/([a-z0-9-_]+)')
 DATASET_EDIT_REGEX = re.compile('/dataset/edit/([a-z0-9-_]+)')
+DATASET_URL_REGEX = re.compile(PACKAGE_URL + '([a-z0-9-_]+)')
+
+# Reporting API quotas: 10 queries per second per user and at most 10
+# requests in flight for a view at any time.
+# https://developers.google.com/analytics/devguides/reporting/core/v3/limits-quotas
+DEFAULT_API_RATE = 5.0
+DEFAULT_API_BURST = 10
+DEFAULT_API_RETRIES = 5
+DEFAULT_API_BACKOFF = 1.0
+DEFAULT_API_BACKOFF_MAX = 32.0
+# seconds that responses covering days GA may still update are cached
+DEFAULT_API_CACHE_TTL = 3600
+MAX_WORKERS = 10
+GA_MAX_RESULTS = 10000
+
+# rows are resolved and written this many at a time
+SAVE_CHUNK_SIZE = 5000
+# days younger than this may still change in GA, so are loaded again
+FINAL_AFTER_DAYS = 2
+# pages of results a worker may fetch ahead of the rows being saved
+PREFETCH_PAGES = 2
+# marks the end of a range's pages in its prefetch queue
+_END = object()
+
+
+def _dataset_name(url):
+    """Return the name of the dataset whose page or edit page ``url`` is,
+    or None."""
+    match = DATASET_EDIT_REGEX.match(url) or DATASET_URL_REGEX.match(url)
+    if match and match.end() == len(url):
+        return match.group(1)
+    return None
+
+
+def _split_days(days, rows):
+    """Split rows like ('20170101', url, count), ordered by date, into a
+    (day, (url, count) iterator) pair for each of days.
+
+    Each day's rows must be consumed before moving on to the next day.
+    """
+    groups = itertools.groupby(rows, key=lambda row: row[0])
+    group = next(groups, None)
+    for day in days:
+        key = day.strftime('%Y%m%d')
+        while group and group[0] < key:
+            group = next(groups, None)
+        if group and group[0] == key:
+            yield day, ((url, count) for date, url, count in group[1])
+            group = next(groups, None)
+        else:
+            yield day, iter(())
 
 
 class InitDB(CkanCommand):
@@ -31,6 +89,15 @@ class InitDB(CkanCommand):
         model.Session.remove()
         model.Session.configure(bind=model.meta.engine)
         dbutil.init_tables()
+        if model.meta.engine.dialect.name == 'postgresql':
+            # fill the rollups from the days loaded so far
+            connection = model.meta.engine.connect()
+            try:
+                trans = connection.begin()
+                dbutil.update_rollups(connection)
+                trans.commit()
+            finally:
+                connection.close()
         log.info("Set up statistics tables in main database")
 
 
@@ -43,6 +110,10 @@ class LoadAnalytics(CkanCommand):
                         credentials_file specifies the OAUTH credentials file
                         date specifies start date for retrieving
                         analytics data YYYY-MM-DD format
+        --workers N     fetch up to N days at once in internal mode
+                        (at most 10, default 1)
+        --range-days N  in internal mode, fetch N days with each
+                        (paginated) query rather than one day (default 1)
     """
     summary = __doc__.split('\n')[0]
     usage = __doc__
@@ -51,6 +122,19 @@ class LoadAnalytics(CkanCommand):
     TEST_HOST = None
     CONFIG = None
 
+    def __init__(self, name):
+        super(LoadAnalytics, self).__init__(name)
+        # per thread state, see _http
+        self._local = threading.local()
+        if not self.parser.has_option('--workers'):
+            self.parser.add_option(
+                '--workers', dest='workers', type='int', default=1,
+                help='Number of days to fetch from Google Analytics at once')
+        if not self.parser.has_option('--range-days'):
+            self.parser.add_option(
+                '--range-days', dest='range_days', type='int', default=1,
+                help='Number of days to fetch with each query')
+
     def command(self):
         if not self.CONFIG:
             self._load_config()
@@ -59,163 +143,402 @@ class LoadAnalytics(CkanCommand):
         self.resource_url_tag = self.CONFIG.get(
             'googleanalytics_resource_prefix',
             DEFAULT_RESOURCE_URL_TAG)
+        # shared by all threads, so that together they stay within quota
+        self.rate_limiter = RateLimiter(
+            float(self.CONFIG.get('googleanalytics.api_rate',
+                                  DEFAULT_API_RATE)),
+            int(self.CONFIG.get('googleanalytics.api_burst',
+                                DEFAULT_API_BURST)),
+            retries=int(self.CONFIG.get('googleanalytics.api_retries',
+                                        DEFAULT_API_RETRIES)),
+            backoff=float(self.CONFIG.get('googleanalytics.api_backoff',
+                                          DEFAULT_API_BACKOFF)),
+            backoff_max=float(self.CONFIG.get(
+                'googleanalytics.api_backoff_max', DEFAULT_API_BACKOFF_MAX)))
+        self.response_cache = None
+        cache_dir = self.CONFIG.get('googleanalytics.api_cache_dir')
+        if cache_dir:
+            self.response_cache = ResponseCache(
+                cache_dir, int(self.CONFIG.get('googleanalytics.api_cache_ttl',
+                                               DEFAULT_API_CACHE_TTL)))
 
         # funny dance we need to do to make sure we've got a
         # configured session
         model.Session.remove()
         model.Session.configure(bind=model.meta.engine)
-        self.parse_and_save()
+        try:
+            self.parse_and_save()
+        finally:
+            msg = ('Waited %.1f seconds for the Google Analytics rate limit '
+                   'and %.1f seconds backing off after errors' %
+                   (self.rate_limiter.waited, self.rate_limiter.backed_off))
+            if self.response_cache:
+                msg += ('; %d responses came from the cache, %d did not' %
+                        (self.response_cache.hits, self.response_cache.misses))
+            log.info(msg)
+            print msg
 
     def internal_save(self, packages_data, summary_date):
-        engine = model.meta.engine
-        # clear out existing data before adding new
-        sql = '''DELETE FROM tracking_summary
-                 WHERE tracking_date='%s'; ''' % summary_date
-        engine.execute(sql)
+        """Replace the tracking_summary rows of summary_date with
+        packages_data, a dict or an iterable of (url, count) pairs.
+
+        The rows are written a chunk at a time as they arrive, but the
+        whole day is replaced in a single transaction, together with its
+        checkpoint in the googleanalytics_sync table, so readers never see
+        a partly loaded day.
 
-        for url, count in packages_data.iteritems():
+        Returns the number of rows saved.
+        """
+        if isinstance(packages_data, dict):
+            packages_data = packages_data.iteritems()
+        engine = model.meta.engine
+        connection = engine.connect()
+        trans = connection.begin()
+        try:
+            # clear out existing data before adding new
+            sql = '''DELETE FROM tracking_summary
+                     WHERE tracking_date = %s;'''
+            connection.execute(sql, summary_date)
+
+            saved = 0
+            packages_data = iter(packages_data)
+            while True:
+                chunk = list(itertools.islice(packages_data, SAVE_CHUNK_SIZE))
+                if not chunk:
+                    break
+                saved += len(chunk)
+                self._save_chunk(connection, chunk, summary_date)
+            self._finish_day(connection, summary_date, saved)
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+        finally:
+            connection.close()
+        return saved
+
+    def _finish_day(self, connection, summary_date, saved):
+        if saved > SAVE_CHUNK_SIZE:
+            # the same url may arrive in more than one chunk
+            self._merge_duplicates(connection, summary_date)
+
+        # update summary totals for resources and pages. Only rows that
+        # have not been summed yet are updated, and only the last weeks of
+        # their urls / datasets are read, so the cost grows with the size
+        # of the load rather than with the size of the table.
+        self._update_totals(connection, 'resource', 'url')
+        self._update_totals(connection, 'page', 'package_id',
+                            """AND package_id IS NOT NULL
+                               AND package_id != '%s'""" % PACKAGE_NOT_FOUND)
+        dbutil.update_rollups(connection, summary_date)
+
+        # GA may still update the numbers of the last few days
+        final = (datetime.datetime.now() - summary_date).days > FINAL_AFTER_DAYS
+        dbutil.save_sync_state(connection, self.profile_id, summary_date,
+                               saved, final=final)
+
+    def _save_chunk(self, connection, packages_data, summary_date):
+        rows = {}
+        names = set()
+        for url, count in packages_data:
+            if url in rows:
+                # several GA paths can map to the same url
+                rows[url][1] += count
+                continue
             # If it matches the resource then we should mark it as a resource.
-            # For resources we don't currently find the package ID.
+            # Resources are left without a package ID: CKAN reads a
+            # dataset's totals from the latest row with its package_id,
+            # whatever its tracking_type.
             if RESOURCE_URL_REGEX.match(url):
-                tracking_type = 'resource'
-            else:
-                tracking_type = 'page'
-
-            sql = '''INSERT INTO tracking_summary
-                     (url, count, tracking_date, tracking_type)
-                     VALUES (%s, %s, %s, %s);'''
-            engine.execute(sql, url, count, summary_date, tracking_type)
-
-        # get ids for dataset urls
-        sql = '''UPDATE tracking_summary t
-                 SET package_id = COALESCE(
-                     (SELECT id FROM package p WHERE t.url =  %s || p.name)
-                     ,'~~not~found~~')
-                 WHERE t.package_id IS NULL AND tracking_type = 'page';'''
-        engine.execute(sql, PACKAGE_URL)
-
-        # get ids for dataset edit urls which aren't captured otherwise
-        sql = '''UPDATE tracking_summary t
-                 SET package_id = COALESCE(
-                     (SELECT id FROM package p WHERE t.url =  %s || p.name)
-                     ,'~~not~found~~')
-                 WHERE t.package_id = '~~not~found~~' AND tracking_type = 'page';'''
-        engine.execute(sql, '%sedit/' % PACKAGE_URL)
-
-        # update summary totals for resources
-        sql = '''UPDATE tracking_summary t1
-                 SET running_total = (
-                    SELECT sum(count)
-                    FROM tracking_summary t2
-                    WHERE t1.url = t2.url
-                    AND t2.tracking_date <= t1.tracking_date
-                 ) + t1.count
-                 ,recent_views = (
-                    SELECT sum(count)
-                    FROM tracking_summary t2
-                    WHERE t1.url = t2.url
-                    AND t2.tracking_date <= t1.tracking_date AND t2.tracking_date >= t1.tracking_date - 14
-                 ) + t1.count
-                 WHERE t1.running_total = 0 AND tracking_type = 'resource';'''
-        engine.execute(sql)
-
-        # update summary totals for pages
-        sql = '''UPDATE tracking_summary t1
-                 SET running_total = (
-                    SELECT sum(count)
-                    FROM tracking_summary t2
-                    WHERE t1.package_id = t2.package_id
-                    AND t2.tracking_date <= t1.tracking_date
-                 ) + t1.count
-                 ,recent_views = (
-                    SELECT sum(count)
-                    FROM tracking_summary t2
-                    WHERE t1.package_id = t2.package_id
-                    AND t2.tracking_date <= t1.tracking_date AND t2.tracking_date >= t1.tracking_date - 14
-                 ) + t1.count
-                 WHERE t1.running_total = 0 AND tracking_type = 'page'
-                 AND t1.package_id IS NOT NULL
-                 AND t1.package_id != '~~not~found~~';'''
-        engine.execute(sql)
+                rows[url] = [url, count, summary_date, 'resource', None]
+                continue
+            name = _dataset_name(url)
+            if name:
+                names.add(name)
+            rows[url] = [url, count, summary_date, 'page', name]
+
+        # get ids for dataset and dataset edit urls in one lookup by name
+        package_ids = dbutil.get_package_ids_by_name(connection, names)
+        rows = [(url, count, date, tracking_type,
+                 package_ids.get(name, PACKAGE_NOT_FOUND)
+                 if tracking_type == 'page' else None)
+                for url, count, date, tracking_type, name in rows.values()]
+        dbutil.insert_tracking_summary(connection, rows)
+
+    def _merge_duplicates(self, connection, summary_date):
+        """Sum the counts of the day's rows that share a url into a
+        single row"""
+        sql = '''WITH duplicates AS (
+                    DELETE FROM tracking_summary
+                    WHERE tracking_date = %(tracking_date)s
+                    AND url IN (
+                        SELECT url FROM tracking_summary
+                        WHERE tracking_date = %(tracking_date)s
+                        GROUP BY url HAVING count(*) > 1)
+                    RETURNING url, count, tracking_type, package_id
+                 )
+                 INSERT INTO tracking_summary
+                    (url, count, tracking_date, tracking_type, package_id)
+                 SELECT url, sum(count), %(tracking_date)s, tracking_type,
+                        package_id
+                 FROM duplicates
+                 GROUP BY url, tracking_type, package_id;'''
+        connection.execute(sql, tracking_date=summary_date)
+
+    def _update_totals(self, connection, tracking_type, key, condition=''):
+        """Set running_total and recent_views (last 14 days) of the rows
+        with a running_total of 0, summing counts per ``key``.
+
+        As before, the row's own count is added on top of both sums.
+        Every row before the earliest unsummed day is summed already, so
+        the running totals carry on from each key's last row from before
+        the 14 days recent_views needs, and only those days are read.
+        """
+        sql = '''WITH keys AS (
+                    SELECT DISTINCT {key} FROM tracking_summary
+                    WHERE running_total = 0
+                    AND tracking_type = %(tracking_type)s {condition}
+                 ), bound AS (
+                    SELECT min(tracking_date) - 14 AS first_date
+                    FROM tracking_summary
+                    WHERE running_total = 0
+                    AND tracking_type = %(tracking_type)s {condition}
+                 ), totals AS (
+                    SELECT url, tracking_date, {key} AS group_key,
+                           running_total AS summed,
+                           sum(count) OVER (
+                               PARTITION BY {key} ORDER BY tracking_date
+                               RANGE BETWEEN UNBOUNDED PRECEDING
+                               AND CURRENT ROW
+                           ) + count AS running_total,
+                           sum(count) OVER (
+                               PARTITION BY {key} ORDER BY tracking_date
+                               RANGE BETWEEN INTERVAL '14 days' PRECEDING
+                               AND CURRENT ROW
+                           ) + count AS recent_views
+                    FROM tracking_summary
+                    WHERE tracking_type = %(tracking_type)s {condition}
+                    AND tracking_date >= (SELECT first_date FROM bound)
+                    AND {key} IN (SELECT {key} FROM keys)
+                 )
+                 UPDATE tracking_summary t
+                 SET running_total = s.running_total + coalesce((
+                        -- the total of the key's last row before the window
+                        SELECT running_total - count FROM tracking_summary
+                        WHERE {key} = s.group_key
+                        AND tracking_date < (SELECT first_date FROM bound)
+                        AND tracking_type = %(tracking_type)s {condition}
+                        ORDER BY tracking_date DESC LIMIT 1), 0),
+                     recent_views = s.recent_views
+                 FROM totals s
+                 WHERE t.url = s.url AND t.tracking_date = s.tracking_date
+                 AND s.summed = 0
+                 AND t.tracking_type = %(tracking_type)s;'''.format(
+            key=key, condition=condition)
+        connection.execute(sql, tracking_type=tracking_type)
 
     def bulk_import(self):
+        missing = dbutil.missing_tables()
+        if missing:
+            raise Exception('Tables %s are missing, run paster initdb'
+                            % ', '.join(missing))
         if len(self.args) == 3:
             # Get summeries from specified date
             start_date = datetime.datetime.strptime(self.args[2], '%Y-%m-%d')
+            sync_state = {}
         else:
-            # No date given. See when we last have data for and get data
-            # from 2 days before then in case new data is available.
-            # If no date here then use 2010-01-01 as the start date
+            # No date given, resume from the checkpoints of the last run
+            sync_state = dbutil.get_sync_state(self.profile_id)
+            start_date = self._resume_date(sync_state)
+        end_date = datetime.datetime.now()
+        range_days = max(getattr(self.options, 'range_days', 1), 1)
+
+        # days that are final are skipped, ranges only cover consecutive
+        # days. Other days are loaded again from the start, as GA may have
+        # changed their numbers.
+        ranges = []
+        while start_date < end_date:
+            day = start_date
+            start_date += datetime.timedelta(1)
+            state = sync_state.get(day.date())
+            if state and state['final']:
+                continue
+            if ranges and len(ranges[-1]) < range_days \
+                    and ranges[-1][-1] + datetime.timedelta(1) == day:
+                ranges[-1].append(day)
+            else:
+                ranges.append([day])
+        workers = min(max(getattr(self.options, 'workers', 1), 1), MAX_WORKERS)
+
+        # ranges are fetched concurrently, but handed back in date order so
+        # that the running totals are summed correctly
+        for days, pages in self._prefetch(ranges, workers):
+            rows = itertools.chain.from_iterable(pages)
+            for day, packages_data in _split_days(days, rows):
+                saved = self.internal_save(packages_data, day)
+                log.info('%s received %s' % (saved, day))
+                print '%s received %s' % (saved, day)
+
+    def _resume_date(self, sync_state):
+        """Return the first day that is not final, according to the
+        checkpoints of the last run."""
+        pending = [day for day, state in sync_state.iteritems()
+                   if not state['final']]
+        if pending:
+            start_date = min(pending)
+        elif sync_state:
+            start_date = max(sync_state) + datetime.timedelta(1)
+        else:
+            # No checkpoints yet. See when we last have data for and get
+            # data from 2 days before then in case new data is available.
+            # If no date here then use 2011-01-01 as the start date
             engine = model.meta.engine
             sql = '''SELECT tracking_date from tracking_summary
                      ORDER BY tracking_date DESC LIMIT 1;'''
             result = engine.execute(sql).fetchall()
-            if result:
-                start_date = result[0]['tracking_date']
-                start_date += datetime.timedelta(-2)
-                # convert date to datetime
-                combine = datetime.datetime.combine
-                start_date = combine(start_date, datetime.time(0))
-            else:
-                start_date = datetime.datetime(2011, 1, 1)
-        end_date = datetime.datetime.now()
-        while start_date < end_date:
-            stop_date = start_date + datetime.timedelta(1)
-            packages_data = self.get_ga_data_new(start_date=start_date,
-                                                 end_date=stop_date)
-            self.internal_save(packages_data, start_date)
-            # sleep to rate limit requests
-            time.sleep(0.25)
-            start_date = stop_date
-            log.info('%s received %s' % (len(packages_data), start_date))
-            print '%s received %s' % (len(packages_data), start_date)
-
-    def get_ga_data_new(self, start_date=None, end_date=None):
-        """Get raw data from Google Analtyics for packages and
-        resources.
-
-        Returns a dictionary like::
-
-           {'identifier': 3}
+            if not result:
+                return datetime.datetime(2011, 1, 1)
+            start_date = result[0]['tracking_date']
+            start_date += datetime.timedelta(-2)
+        # convert date to datetime
+        return datetime.datetime.combine(start_date, datetime.time(0))
+
+    def _prefetch(self, ranges, workers):
+        """Yield (days, pages) for each list of consecutive days in
+        ranges, in order, where pages iterates over the results of
+        iter_ga_pages for the days.
+
+        With more than one worker the ranges are fetched by a pool of
+        threads, each of which stays at most PREFETCH_PAGES pages ahead of
+        the consumer.
         """
-        start_date = start_date.strftime("%Y-%m-%d")
-        end_date = end_date.strftime("%Y-%m-%d")
+        if workers == 1 or len(ranges) == 1:
+            for days in ranges:
+                yield days, self.iter_ga_pages(days[0], days[-1])
+            return
+
+        cancelled = threading.Event()
+
+        def put(pages, item):
+            while not cancelled.is_set():
+                try:
+                    pages.put(item, timeout=1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def produce(days, pages):
+            try:
+                for page in self.iter_ga_pages(days[0], days[-1]):
+                    if not put(pages, page):
+                        return
+                put(pages, _END)
+            except Exception:
+                put(pages, sys.exc_info())
+
+        def consume(pages):
+            while True:
+                item = pages.get()
+                if item is _END:
+                    return
+                if isinstance(item, tuple):
+                    raise item[0], item[1], item[2]
+                yield item
+
+        pool = ThreadPool(workers)
+        try:
+            queues = []
+            for days in ranges:
+                pages = Queue.Queue(PREFETCH_PAGES)
+                pool.apply_async(produce, (days, pages))
+                queues.append((days, pages))
+            for days, pages in queues:
+                yield days, consume(pages)
+        finally:
+            cancelled.set()
+            pool.terminate()
+
+    def _ga_get(self, **params):
+        """Run a Core Reporting API query through the rate limiter, or
+        answer it from the response cache"""
+        cache = self.response_cache
+        if cache:
+            results = cache.get(params)
+            if results is not None:
+                return results
+        request = self.service.data().ga().get(**params)
+        http = self._http()
+        results = self.rate_limiter.call(lambda: request.execute(http=http))
+        if cache:
+            # the numbers of finalized days never change again
+            cache.set(params, results,
+                      ttl=None if self._is_final(params.get('end_date'))
+                      else cache.ttl)
+        return results
 
-        packages = {}
-        query = 'ga:pagePath=~%s,ga:pagePath=~%s' % \
-                    (PACKAGE_URL, self.resource_url_tag)
-        metrics = 'ga:uniquePageviews'
-        sort = '-ga:uniquePageviews'
-
-        start_index = 1
-        max_results = 10000
-        # data retrival is chunked
-        completed = False
-        while not completed:
-            results = self.service.data().ga().get(ids='ga:%s' % self.profile_id,
-                                 filters=query,
-                                 dimensions='ga:pagePath',
-                                 start_date=start_date,
-                                 start_index=start_index,
-                                 max_results=max_results,
-                                 metrics=metrics,
-                                 sort=sort,
-                                 end_date=end_date).execute()
-            result_count = len(results.get('rows', []))
-            if result_count < max_results:
-                completed = True
-
-            for result in results.get('rows', []):
-                package = result[0]
-                package = '/' + '/'.join(package.split('/')[2:])
-                count = result[1]
-                packages[package] = int(count)
+    def _http(self):
+        """The authorized httplib2.Http of the current thread; the one of
+        the service must not be shared by the prefetch workers"""
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = self._local.http = self._authorized_http()
+        return http
 
+    def _authorized_http(self):
+        from ga_auth import authorized_http
+        return authorized_http(self.args[0])
+
+    def _is_final(self, date):
+        try:
+            date = datetime.datetime.strptime(date, '%Y-%m-%d')
+        except (TypeError, ValueError):
+            return False
+        return (datetime.datetime.now() - date).days > FINAL_AFTER_DAYS
+
+    def _iter_ga_results(self, start_index=1, max_results=GA_MAX_RESULTS,
+                         **params):
+        """Run a Core Reporting API query, yielding each page of
+        results"""
+        while True:
+            results = self._ga_get(start_index=start_index,
+                                   max_results=max_results, **params)
+            yield results
+            if len(results.get('rows', [])) < max_results:
+                return
             start_index += max_results
 
-            # rate limiting
-            time.sleep(0.2)
-        return packages
+    def iter_ga_pages(self, start_date, end_date):
+        """Get raw data from Google Analytics for packages and resources
+        for every day from start_date to end_date (inclusive).
+
+        Yields the results a page at a time, in date order, as lists
+        like::
+
+           [('20170101', '/dataset/name', 3), ...]
+        """
+        query = 'ga:pagePath=~%s,ga:pagePath=~%s' % \
+                    (PACKAGE_URL, self.resource_url_tag)
+        sampled = False
+        for results in self._iter_ga_results(
+                ids='ga:%s' % self.profile_id,
+                filters=query,
+                dimensions='ga:date,ga:pagePath',
+                start_date=start_date.strftime('%Y-%m-%d'),
+                end_date=end_date.strftime('%Y-%m-%d'),
+                metrics='ga:uniquePageviews',
+                # by date, as the days are split by _split_days, then a
+                # total order, so that pages neither overlap nor skip rows
+                sort='ga:date,-ga:uniquePageviews,ga:pagePath'):
+            sampled = sampled or results.get('containsSampledData', False)
+            yield [(date, '/' + '/'.join(package.split('/')[2:]), int(count))
+                   for date, package, count in results.get('rows', [])]
+
+        if sampled:
+            log.warning('Google Analytics returned sampled data for %s - %s, '
+                        'try a smaller --range-days' % (
+                            start_date.strftime('%Y-%m-%d'),
+                            end_date.strftime('%Y-%m-%d')))
 
     def parse_and_save(self):
         """Grab raw data from Google Analytics and save to the database"""
@@ -241,35 +564,60 @@ class LoadAnalytics(CkanCommand):
             packages_data = self.get_ga_data(query_filter=query)
             self.save_ga_data(packages_data)
             log.info("Saved %s records from google" % len(packages_data))
+        # let the web workers know their cached stats are stale
+        dbutil.bump_stats_version()
 
     def save_ga_data(self, packages_data):
         """Save tuples of packages_data to the database
         """
-        for identifier, visits in packages_data.items():
+        connection = model.Session.connection()
+        items = packages_data.items()
+        for start in range(0, len(items), SAVE_CHUNK_SIZE):
+            self._save_ga_chunk(connection,
+                                items[start:start + SAVE_CHUNK_SIZE])
+        model.Session.commit()
+
+    def _save_ga_chunk(self, connection, items):
+        # resolve the chunk's resources and packages with one query each
+        resources = []
+        packages = []
+        for identifier, visits in items:
             recently = visits.get('recent', 0)
             ever = visits.get('ever', 0)
             matches = RESOURCE_URL_REGEX.match(identifier)
             if matches:
-                resource_url = identifier[len(self.resource_url_tag):]
-                resource = model.Session.query(model.Resource).autoflush(True)\
-                           .filter_by(id=matches.group(1)).first()
-                if not resource:
-                    log.warning("Couldn't find resource %s" % resource_url)
-                    continue
-                dbutil.update_resource_visits(resource.id, recently, ever)
-                log.info("Updated %s with %s visits" % (resource.id, visits))
+                resources.append((identifier, matches.group(1), visits,
+                                  recently, ever))
             else:
                 package_name = identifier[len(PACKAGE_URL):]
                 if "/" in package_name:
                     log.warning("%s not a valid package name" % package_name)
                     continue
-                item = model.Package.by_name(package_name)
-                if not item:
-                    log.warning("Couldn't find package %s" % package_name)
-                    continue
-                dbutil.update_package_visits(item.id, recently, ever)
-                log.info("Updated %s with %s visits" % (item.id, visits))
-        model.Session.commit()
+                packages.append((package_name, visits, recently, ever))
+
+        resource_ids = dbutil.get_resource_ids(
+            connection, [resource[1] for resource in resources])
+        rows = []
+        for identifier, resource_id, visits, recently, ever in resources:
+            if resource_id not in resource_ids:
+                resource_url = identifier[len(self.resource_url_tag):]
+                log.warning("Couldn't find resource %s" % resource_url)
+                continue
+            rows.append((resource_id, recently, ever))
+            log.info("Updated %s with %s visits" % (resource_id, visits))
+        dbutil.update_resource_visits_many(rows)
+
+        package_ids = dbutil.get_package_ids_by_name(
+            connection, [package[0] for package in packages])
+        rows = []
+        for package_name, visits, recently, ever in packages:
+            if package_name not in package_ids:
+                log.warning("Couldn't find package %s" % package_name)
+                continue
+            package_id = package_ids[package_name]
+            rows.append((package_id, recently, ever))
+            log.info("Updated %s with %s visits" % (package_id, visits))
+        dbutil.update_package_visits_many(rows)
 
     def ga_query(self, query_filter=None, from_date=None, to_date=None,
                  start_index=1, max_results=10000, metrics=None, sort=None):
@@ -287,16 +635,15 @@ class LoadAnalytics(CkanCommand):
 
         print '%s -> %s' % (from_date, to_date)
 
-        results = self.service.data().ga().get(ids='ga:' + self.profile_id,
-                                      start_date=from_date,
-                                      end_date=to_date,
-                                      dimensions='ga:pagePath',
-                                      metrics=metrics,
-                                      sort=sort,
-                                      start_index=start_index,
-                                      filters=query_filter,
-                                      max_results=max_results
-                                      ).execute()
+        results = self._ga_get(ids='ga:' + self.profile_id,
+                               start_date=from_date,
+                               end_date=to_date,
+                               dimensions='ga:pagePath',
+                               metrics=metrics,
+                               sort=sort,
+                               start_index=start_index,
+                               filters=query_filter,
+                               max_results=max_results)
         return results
 
     def get_ga_data(self, query_filter=None, start_date=None, end_date=None):
@@ -316,11 +663,19 @@ class LoadAnalytics(CkanCommand):
         dates = {'recent': recent_date, 'ever': floor_date}
         for date_name, date in dates.iteritems():
             for query in queries:
-                results = self.ga_query(query_filter=query,
-                                        metrics='ga:uniquePageviews',
-                                        from_date=date)
-                if 'rows' in results:
-                    for result in results.get('rows'):
+                start_index = 1
+                completed = False
+                while not completed:
+                    results = self.ga_query(query_filter=query,
+                                            metrics='ga:uniquePageviews',
+                                            from_date=date,
+                                            start_index=start_index,
+                                            max_results=GA_MAX_RESULTS)
+                    rows = results.get('rows', [])
+                    if len(rows) < GA_MAX_RESULTS:
+                        completed = True
+                    start_index += GA_MAX_RESULTS
+                    for result in rows:
                         package = result[0]
                         if not package.startswith(PACKAGE_URL):
                             package = '/' + '/'.join(package.split('/')[2:])
@@ -1,5 +1,6 @@
+import calendar
 import logging
-from ckan.lib.base import BaseController, c, render, request
+from ckan.lib.base import BaseController, c, render, request, response
 import dbutil
 
 import ckan.logic as logic
@@ -14,11 +15,53 @@ from ckan.controllers.api import ApiController
 log = logging.getLogger('ckanext.googleanalytics')
 
 
+def _not_modified(etag, version):
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return etag in tags or '*' in tags
+    if_modified_since = request.if_modified_since
+    if if_modified_since:
+        return calendar.timegm(if_modified_since.utctimetuple()) >= \
+            int(float(version))
+    return False
+
+
 class GAController(BaseController):
     def view(self):
-        # get package objects corresponding to popular GA content
-        c.top_resources = dbutil.get_top_resources(limit=10)
-        return render('summary.html')
+        stats_cache = plugin.GoogleAnalyticsPlugin.stats_cache
+        version = plugin.stats_version()
+        # the rest of the page differs between logged in users, so only
+        # pages for anonymous users are cached or revalidated
+        anonymous = not c.user
+        if anonymous and version:
+            etag = '"%s"' % hashlib.md5(version).hexdigest()
+            response.headers['ETag'] = etag
+            response.last_modified = int(float(version))
+            if _not_modified(etag, version):
+                response.status_int = 304
+                return ''
+
+        page_key = ('top_page', version, request.environ.get('CKAN_LANG'))
+        if anonymous:
+            page = stats_cache.get(page_key)
+            if page is not None:
+                return page
+
+        # the most popular datasets and resources, as plain tuples that
+        # can be cached across requests and rendered without more queries
+        top_key = ('top', version)
+        top = stats_cache.get(top_key)
+        if top is None:
+            top = (dbutil.get_top_package_rows(limit=10),
+                   dbutil.get_top_resource_rows(limit=10))
+            stats_cache.set(top_key, top)
+        c.top_packages, c.top_resources = top
+
+        page = render('summary.html')
+        if anonymous:
+            stats_cache.set(page_key, page)
+        return page
 
 
 class GAApiController(ApiController):
@@ -39,74 +82,75 @@ class GAApiController(ApiController):
                 "ea": request_obj_type+request_function,
                 "el": request_id,
             }
-            plugin.GoogleAnalyticsPlugin.analytics_queue.put(data_dict)
+            plugin.GoogleAnalyticsPlugin.analytics_sender.send(data_dict)
+
+    def _track(self, name):
+        # checked before anything is parsed or built for the event
+        return config.get('googleanalytics.id') and \
+            plugin.GoogleAnalyticsPlugin.api_event_filter.accept(
+                name, request.environ.get('HTTP_USER_AGENT'))
+
+    def _post_rest_analytics(self, user, register, subregister, function,
+                             id):
+        request_obj_type = register + \
+            ("_"+str(subregister) if subregister else "")
+        if self._track(request_obj_type + "_" + function):
+            self._post_analytics(user, request_obj_type, function, id)
 
     def action(self, logic_function, ver=None):
-        try:
-            function = logic.get_action(logic_function)
-            side_effect_free = getattr(function, 'side_effect_free', False)
-            request_data = self._get_request_data(
-                try_url_params=side_effect_free)
-            if isinstance(request_data, dict):
-                id = request_data.get('id', '')
-                if 'q' in request_data:
-                    id = request_data['q']
-                if 'query' in request_data:
-                    id = request_data['query']
-                self._post_analytics(c.user, logic_function, '', id)
-        except Exception, e:
-            log.debug(e)
-            pass
+        if self._track(logic_function):
+            try:
+                function = logic.get_action(logic_function)
+                side_effect_free = getattr(function, 'side_effect_free', False)
+                request_data = self._get_request_data(
+                    try_url_params=side_effect_free)
+                if isinstance(request_data, dict):
+                    id = request_data.get('id', '')
+                    if 'q' in request_data:
+                        id = request_data['q']
+                    if 'query' in request_data:
+                        id = request_data['query']
+                    self._post_analytics(c.user, logic_function, '', id)
+            except Exception, e:
+                log.debug(e)
+                pass
 
         return ApiController.action(self, logic_function, ver)
 
     def list(self, ver=None, register=None,
              subregister=None, id=None):
-        self._post_analytics(c.user,
-                             register +
-                             ("_"+str(subregister) if subregister else ""),
-                             "list",
-                             id)
+        self._post_rest_analytics(c.user, register, subregister, "list", id)
         return ApiController.list(self, ver, register, subregister, id)
 
     def show(self, ver=None, register=None,
              subregister=None, id=None, id2=None):
-        self._post_analytics(c.user,
-                             register +
-                             ("_"+str(subregister) if subregister else ""),
-                             "show",
-                             id)
+        self._post_rest_analytics(c.user, register, subregister, "show", id)
         return ApiController.show(self, ver, register, subregister, id, id2)
 
     def update(self, ver=None, register=None,
                subregister=None, id=None, id2=None):
-        self._post_analytics(c.user,
-                             register +
-                             ("_"+str(subregister) if subregister else ""),
-                             "update",
-                             id)
+        self._post_rest_analytics(c.user, register, subregister, "update",
+                                  id)
         return ApiController.update(self, ver, register, subregister, id, id2)
 
     def delete(self, ver=None, register=None,
                subregister=None, id=None, id2=None):
-        self._post_analytics(c.user,
-                             register +
-                             ("_"+str(subregister) if subregister else ""),
-                             "delete",
-                             id)
+        self._post_rest_analytics(c.user, register, subregister, "delete",
+                                  id)
         return ApiController.delete(self, ver, register, subregister, id, id2)
 
     def search(self, ver=None, register=None):
-        id = None
-        try:
-            params = MultiDict(self._get_search_params(request.params))
-            if 'q' in params.keys():
-                id = params['q']
-            if 'query' in params.keys():
-                id = params['query']
-        except ValueError, e:
-            log.debug(str(e))
-            pass
-        self._post_analytics(c.user, register, "search", id)
+        if self._track(register + "_search"):
+            id = None
+            try:
+                params = MultiDict(self._get_search_params(request.params))
+                if 'q' in params.keys():
+                    id = params['q']
+                if 'query' in params.keys():
+                    id = params['query']
+            except ValueError, e:
+                log.debug(str(e))
+                pass
+            self._post_analytics(c.user, register, "search", id)
 
         return ApiController.search(self, ver, register)
@@ -1,6 +1,10 @@
-from sqlalchemy import Table, Column, Integer, String, MetaData
-from sqlalchemy.sql import select, text
-from sqlalchemy import func
+import datetime
+import time
+from cStringIO import StringIO
+
+from sqlalchemy import Table, Column, Integer, String, MetaData, Date, \
+    Boolean, UnicodeText
+from sqlalchemy.sql import select, text, bindparam
 
 import ckan.model as model
 # from ckan.model.authz import PSEUDO_USER__VISITOR
@@ -8,6 +12,20 @@ from ckan.lib.base import *
 
 cached_tables = {}
 
+TRACKING_SUMMARY_COLUMNS = ('url', 'count', 'tracking_date', 'tracking_type',
+                            'package_id')
+# maximum number of values in one IN (...) list
+IN_CHUNK_SIZE = 1000
+SYNC_TABLE = 'googleanalytics_sync'
+# tracking_summary counts summed per url and week / month, coarsest first.
+# Their tracking_date is the first day of the period.
+ROLLUPS = (('tracking_summary_monthly', 'month'),
+           ('tracking_summary_weekly', 'week'))
+# system_info key changed whenever loadanalytics has saved new stats
+STATS_VERSION_KEY = 'googleanalytics.stats_version'
+# package_id of page rows that are not a dataset's page
+PACKAGE_NOT_FOUND = '~~not~found~~'
+
 
 def init_tables():
     metadata = MetaData()
@@ -21,7 +39,35 @@ def init_tables():
                                   primary_key=True),
                            Column('visits_recently', Integer),
                            Column('visits_ever', Integer))
+    # the days loadanalytics has loaded, so that it can resume
+    googleanalytics_sync = Table(SYNC_TABLE, metadata,
+                                 Column('profile_id', String(60),
+                                        primary_key=True),
+                                 Column('tracking_date', Date,
+                                        primary_key=True),
+                                 Column('rows', Integer),
+                                 Column('final', Boolean))
+    # a row per period and url, and per dataset the url was resolved to;
+    # package_id is '' where tracking_summary has NULL
+    for table_name, unit in ROLLUPS:
+        Table(table_name, metadata,
+              Column('tracking_date', Date, primary_key=True),
+              Column('url', UnicodeText, primary_key=True),
+              Column('tracking_type', String(30), primary_key=True),
+              Column('package_id', UnicodeText, primary_key=True,
+                     server_default='', index=True),
+              Column('count', Integer))
     metadata.create_all(model.meta.engine)
+    if model.meta.engine.dialect.name == 'postgresql':
+        # loadanalytics finds the rows it has not summed yet, then reads
+        # the last days of their urls / datasets
+        model.meta.engine.execute(
+            'CREATE INDEX IF NOT EXISTS tracking_summary_unsummed '
+            'ON tracking_summary (tracking_type) WHERE running_total = 0')
+        for column in ('url', 'package_id'):
+            model.meta.engine.execute(
+                'CREATE INDEX IF NOT EXISTS tracking_summary_{0}_date '
+                'ON tracking_summary ({0}, tracking_date)'.format(column))
 
 
 def get_table(name):
@@ -33,87 +79,374 @@ def get_table(name):
     return cached_tables[name]
 
 
-def _update_visits(table_name, item_id, recently, ever):
-    stats = get_table(table_name)
+UPSERT_VISITS_SQL = {
+    'postgresql': """INSERT INTO {table} ({id_col}, visits_recently,
+                                        visits_ever)
+                     VALUES (:item_id, :recently, :ever)
+                     ON CONFLICT ({id_col}) DO UPDATE
+                     SET visits_recently = EXCLUDED.visits_recently,
+                         visits_ever = EXCLUDED.visits_ever""",
+    'sqlite': """INSERT OR REPLACE INTO {table} ({id_col}, visits_recently,
+                                               visits_ever)
+                 VALUES (:item_id, :recently, :ever)""",
+}
+
+
+def _update_visits_many(table_name, rows):
     id_col_name = "%s_id" % table_name[:-len("_stats")]
-    id_col = getattr(stats.c, id_col_name)
-    s = select([func.count(id_col)],
-               id_col == item_id)
+    # the last row for an id wins, as it would with one call per row
+    visits = dict((item_id, (recently, ever))
+                  for item_id, recently, ever in rows)
+    if not visits:
+        return
     connection = model.Session.connection()
-    count = connection.execute(s).fetchone()
-    if count and count[0]:
+    sql = UPSERT_VISITS_SQL.get(connection.dialect.name)
+    if sql is None:
+        return _update_or_insert_visits(connection, table_name, id_col_name,
+                                        visits)
+    connection.execute(
+        text(sql.format(table=table_name, id_col=id_col_name)),
+        [{'item_id': item_id, 'recently': recently, 'ever': ever}
+         for item_id, (recently, ever) in visits.iteritems()])
+
+
+def _update_or_insert_visits(connection, table_name, id_col_name, visits):
+    """Upsert for databases without a native one: look up the existing
+    rows, then update those and insert the rest."""
+    stats = get_table(table_name)
+    id_col = getattr(stats.c, id_col_name)
+    existing = set()
+    for chunk in _chunks(visits):
+        s = select([id_col]).where(id_col.in_(chunk))
+        existing.update(row[0] for row in connection.execute(s))
+
+    updates = [{'item_id': item_id, 'recently': recently, 'ever': ever}
+               for item_id, (recently, ever) in visits.iteritems()
+               if item_id in existing]
+    if updates:
         connection.execute(stats.update()\
-            .where(id_col == item_id)\
-            .values(visits_recently=recently,
-                    visits_ever=ever))
-    else:
-        values = {id_col_name: item_id,
-                  'visits_recently': recently,
-                  'visits_ever': ever}
-        connection.execute(stats.insert()\
-                           .values(**values))
+            .where(id_col == bindparam('item_id'))\
+            .values(visits_recently=bindparam('recently'),
+                    visits_ever=bindparam('ever')),
+            updates)
+    inserts = [{id_col_name: item_id,
+                'visits_recently': recently,
+                'visits_ever': ever}
+               for item_id, (recently, ever) in visits.iteritems()
+               if item_id not in existing]
+    if inserts:
+        connection.execute(stats.insert(), inserts)
+
+
+def update_resource_visits_many(rows):
+    """Insert or update ``(resource_id, recently, ever)`` tuples in bulk."""
+    return _update_visits_many("resource_stats", rows)
+
+
+def update_package_visits_many(rows):
+    """Insert or update ``(package_id, recently, ever)`` tuples in bulk."""
+    return _update_visits_many("package_stats", rows)
 
 
 def update_resource_visits(resource_id, recently, ever):
-    return _update_visits("resource_stats",
-                          resource_id,
-                          recently,
-                          ever)
+    return update_resource_visits_many([(resource_id, recently, ever)])
 
 
 def update_package_visits(package_id, recently, ever):
-    return _update_visits("package_stats",
-                          package_id,
-                          recently,
-                          ever)
+    return update_package_visits_many([(package_id, recently, ever)])
 
 
-def get_resource_visits_for_url(url):
-    connection = model.Session.connection()
-    count = connection.execute(
-        text("""SELECT visits_ever FROM resource_stats, resource
-        WHERE resource_id = resource.id
-        AND resource.url = :url"""), url=url).fetchone()
-    return count and count[0] or ""
+def _chunks(items, size=IN_CHUNK_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
 
-""" get_top_packages is broken, and needs to be rewritten to work with
-CKAN 2.*. This is because ckan.authz has been removed in CKAN 2.*
 
-See commit ffa86c010d5d25fa1881c6b915e48f3b44657612
-"""
-def get_top_packages(limit=20):
-    items = []
-    # caveat emptor: the query below will not filter out private
-    # or deleted datasets (TODO)
-    q = model.Session.query(model.Package)
+def get_package_ids_by_name(connection, names):
+    """Return a dict mapping the given dataset names to their ids, using
+    the index on package.name. Unknown names are left out."""
+    package = model.package_table
+    ids = {}
+    for chunk in _chunks(names):
+        s = select([package.c.name, package.c.id])\
+            .where(package.c.name.in_(chunk))
+        ids.update(connection.execute(s).fetchall())
+    return ids
+
+
+def get_resource_ids(connection, ids):
+    """Return the set of the given resource ids that exist."""
+    resource = model.resource_table
+    found = set()
+    for chunk in _chunks(ids):
+        s = select([resource.c.id]).where(resource.c.id.in_(chunk))
+        found.update(row[0] for row in connection.execute(s))
+    return found
+
+
+def _copy_escape(value):
+    '''Escape a value for PostgreSQL's COPY text format.'''
+    if value is None:
+        return '\\N'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t')\
+        .replace('\n', '\\n').replace('\r', '\\r')
+
+
+def insert_tracking_summary(connection, rows):
+    """Insert ``(url, count, tracking_date, tracking_type, package_id)``
+    tuples into tracking_summary in bulk.
+
+    On PostgreSQL the rows are streamed with a single COPY, otherwise
+    they are inserted with one executemany. The caller is responsible for
+    the transaction.
+    """
+    if not rows:
+        return
+    if connection.dialect.driver == 'psycopg2':
+        buf = StringIO()
+        for row in rows:
+            url, count, tracking_date, tracking_type, package_id = row
+            if hasattr(tracking_date, 'strftime'):
+                tracking_date = tracking_date.strftime('%Y-%m-%d')
+            buf.write('\t'.join(
+                _copy_escape(value) for value in
+                (url, count, tracking_date, tracking_type, package_id)))
+            buf.write('\n')
+        buf.seek(0)
+        cursor = connection.connection.cursor()
+        try:
+            cursor.copy_from(buf, 'tracking_summary',
+                             columns=TRACKING_SUMMARY_COLUMNS)
+        finally:
+            cursor.close()
+        return
+    connection.execute(
+        text("""INSERT INTO tracking_summary
+                (url, count, tracking_date, tracking_type, package_id)
+                VALUES (:url, :count, :tracking_date, :tracking_type,
+                        :package_id)"""),
+        [dict(zip(TRACKING_SUMMARY_COLUMNS, row)) for row in rows])
+
+
+def missing_tables():
+    """Return the names of the loadanalytics tables that InitDB has not
+    created yet."""
+    engine = model.meta.engine
+    return [name for name in [SYNC_TABLE] + [r[0] for r in ROLLUPS]
+            if not engine.has_table(name)]
+
+
+def get_sync_state(profile_id):
+    """Return a dict of the loadanalytics checkpoints of a GA profile by
+    date, each a dict with the number of ``rows`` saved and whether the
+    day was ``final``, i.e. GA will not change its numbers any more."""
+    sync = get_table(SYNC_TABLE)
+    s = select([sync.c.tracking_date, sync.c.rows, sync.c.final])\
+        .where(sync.c.profile_id == profile_id)
+    return dict((tracking_date, {'rows': rows, 'final': final})
+                for tracking_date, rows, final
+                in model.meta.engine.execute(s))
+
+
+def save_sync_state(connection, profile_id, tracking_date, rows,
+                    final=False):
+    """Record that a day has been loaded with ``rows`` rows. Call it in
+    the transaction that saved them."""
+    sync = get_table(SYNC_TABLE)
+    if hasattr(tracking_date, 'date'):
+        tracking_date = tracking_date.date()
+    connection.execute(sync.delete()
+                       .where(sync.c.profile_id == profile_id)
+                       .where(sync.c.tracking_date == tracking_date))
+    connection.execute(sync.insert().values(
+        profile_id=profile_id, tracking_date=tracking_date,
+        rows=rows, final=final))
+
+
+def get_resource_visits_for_package(package_id):
+    """Return a dict of the visits_ever counts of a package's resources,
+    by resource id. Resources without stats are left out."""
     connection = model.Session.connection()
+    rows = connection.execute(
+        text("""SELECT resource.id, resource_stats.visits_ever
+        FROM resource JOIN resource_stats
+        ON resource_stats.resource_id = resource.id
+        WHERE resource.package_id = :package_id"""), package_id=package_id)
+    return dict(rows.fetchall())
+
+
+def _top_packages(limit, *columns):
     package_stats = get_table('package_stats')
-    s = select([package_stats.c.package_id,
-                package_stats.c.visits_recently,
-                package_stats.c.visits_ever])\
-                .order_by(package_stats.c.visits_recently.desc())
-    res = connection.execute(s).fetchmany(limit)
-    for package_id, recent, ever in res:
-        item = q.filter("package.id = '%s'" % package_id)
-        if not item.count():
-            continue
-        items.append((item.first(), recent, ever))
-    return items
+    return model.Session.query(*(columns + (package_stats.c.visits_recently,
+                                            package_stats.c.visits_ever)))\
+        .join(package_stats, package_stats.c.package_id == model.Package.id)\
+        .filter(model.Package.state == 'active')\
+        .filter(model.Package.private == False)\
+        .order_by(package_stats.c.visits_recently.desc())\
+        .limit(limit).all()
+
+
+def _top_resources(limit, *columns):
+    resource_stats = get_table('resource_stats')
+    return model.Session.query(*(columns + (resource_stats.c.visits_recently,
+                                            resource_stats.c.visits_ever)))\
+        .select_from(model.Resource)\
+        .join(resource_stats,
+              resource_stats.c.resource_id == model.Resource.id)\
+        .join(model.Package, model.Package.id == model.Resource.package_id)\
+        .filter(model.Resource.state == 'active')\
+        .filter(model.Package.state == 'active')\
+        .filter(model.Package.private == False)\
+        .order_by(resource_stats.c.visits_recently.desc())\
+        .limit(limit).all()
+
+
+def get_top_packages(limit=20):
+    """Return (package, visits_recently, visits_ever) tuples for the
+    active, public datasets with the most recent visits."""
+    return _top_packages(limit, model.Package)
 
 
 def get_top_resources(limit=20):
-    items = []
+    """Return (resource, visits_recently, visits_ever) tuples for the
+    active resources of active, public datasets with the most recent
+    visits."""
+    return _top_resources(limit, model.Resource)
+
+
+def get_top_package_rows(limit=20):
+    """Like get_top_packages, but return plain
+    ``(id, name, title, visits_recently, visits_ever)`` tuples, which can
+    be cached and used outside of the session."""
+    return [tuple(row) for row in _top_packages(
+        limit, model.Package.id, model.Package.name, model.Package.title)]
+
+
+def get_top_resource_rows(limit=20):
+    """Like get_top_resources, but return plain ``(id, name, description,
+    format, package_id, package_name, package_title, visits_recently,
+    visits_ever)`` tuples, read with a single query."""
+    return [tuple(row) for row in _top_resources(
+        limit, model.Resource.id, model.Resource.name,
+        model.Resource.description, model.Resource.format,
+        model.Package.id, model.Package.name, model.Package.title)]
+
+
+def get_stats_version():
+    """Return the time loadanalytics last saved stats, as a string, or
+    None."""
+    return model.get_system_info(STATS_VERSION_KEY)
+
+
+def bump_stats_version():
+    """Record that new stats have been saved, so cached pages using them
+    are invalidated."""
+    model.set_system_info(STATS_VERSION_KEY, '%.6f' % time.time())
+
+
+def update_rollups(connection, tracking_date=None):
+    """Recalculate the weekly and monthly rollups of the periods that
+    contain tracking_date, or of all periods. PostgreSQL only."""
+    for table_name, unit in ROLLUPS:
+        if tracking_date is None:
+            connection.execute('DELETE FROM %s' % table_name)
+            where = ''
+        else:
+            where = '''WHERE tracking_date >= date_trunc(%(unit)s, %(day)s)
+                       AND tracking_date < date_trunc(%(unit)s, %(day)s)
+                                           + ('1 ' || %(unit)s)::interval'''
+            connection.execute(
+                '''DELETE FROM {table}
+                   WHERE tracking_date = date_trunc(%(unit)s, %(day)s)::date
+                '''.format(table=table_name), unit=unit, day=tracking_date)
+        # a url can resolve to different datasets (or to none) on
+        # different days, e.g. after a rename, so the rollups keep them
+        # apart as tracking_summary does
+        connection.execute(
+            '''INSERT INTO {table}
+                   (tracking_date, url, tracking_type, package_id, count)
+               SELECT date_trunc(%(unit)s, tracking_date)::date, url,
+                      tracking_type, coalesce(package_id, ''), sum(count)
+               FROM tracking_summary {where}
+               GROUP BY 1, url, tracking_type, coalesce(package_id, '')
+            '''.format(table=table_name, where=where),
+            unit=unit, day=tracking_date)
+
+
+def _next_month(day):
+    return datetime.date(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+
+def _rollup_ranges(start_date, end_date):
+    """Cover the days from start_date to end_date (inclusive) with as few
+    rows as possible: whole months from the monthly rollup, whole weeks
+    from the weekly one and single days from tracking_summary.
+
+    Returns a list of (table, first, last) tuples, where first and last
+    are the tracking_date of the first and last rows to read.
+    """
+    ranges = []
+    day = start_date
+    while day <= end_date:
+        if day.day == 1 and \
+                _next_month(day) - datetime.timedelta(1) <= end_date:
+            table, next_day = ROLLUPS[0][0], _next_month(day)
+        elif day.weekday() == 0 and \
+                day + datetime.timedelta(6) <= end_date:
+            table, next_day = ROLLUPS[1][0], day + datetime.timedelta(7)
+        else:
+            table, next_day = 'tracking_summary', day + datetime.timedelta(1)
+        if ranges and ranges[-1][0] == table:
+            ranges[-1][2] = day
+        else:
+            ranges.append([table, day, day])
+        day = next_day
+    return [tuple(r) for r in ranges]
+
+
+def get_visit_counts(start_date, end_date, key='package_id',
+                     tracking_type=None, limit=None):
+    """Return (key, count) tuples with the visits from start_date to
+    end_date (inclusive) per url or package_id, most visited first.
+    Counted per package_id, the pages of unknown datasets are left out.
+
+    Whole months and weeks of the range are read from the rollup tables,
+    so a long range reads hundreds of rows per key rather than one per
+    day.
+    """
+    if key not in ('url', 'package_id'):
+        raise ValueError('Unknown key %r' % key)
+    if hasattr(start_date, 'date'):
+        start_date = start_date.date()
+    if hasattr(end_date, 'date'):
+        end_date = end_date.date()
+    params = {'tracking_type': tracking_type}
+    selects = []
+    for i, (table, first, last) in enumerate(
+            _rollup_ranges(start_date, end_date)):
+        selects.append(
+            '''SELECT NULLIF({key}, '') AS {key}, count FROM {table}
+               WHERE tracking_date BETWEEN :first{i} AND :last{i}
+               AND (:tracking_type IS NULL
+                    OR tracking_type = :tracking_type)'''.format(
+                key=key, table=table, i=i))
+        params['first%d' % i] = first
+        params['last%d' % i] = last
+    if not selects:
+        return []
+    condition = ''
+    if key == 'package_id':
+        # the pages of unknown datasets are not visits of a dataset
+        condition = 'AND package_id != :not_found'
+        params['not_found'] = PACKAGE_NOT_FOUND
+    sql = '''SELECT {key}, sum(count) AS count FROM ({selects}) visits
+             WHERE {key} IS NOT NULL {condition}
+             GROUP BY {key} ORDER BY count DESC'''.format(
+        key=key, selects=' UNION ALL '.join(selects), condition=condition)
+    if limit:
+        sql += ' LIMIT :limit'
+        params['limit'] = limit
     connection = model.Session.connection()
-    resource_stats = get_table('resource_stats')
-    s = select([resource_stats.c.resource_id,
-                resource_stats.c.visits_recently,
-                resource_stats.c.visits_ever])\
-                .order_by(resource_stats.c.visits_recently.desc())
-    res = connection.execute(s).fetchmany(limit)
-    for resource_id, recent, ever in res:
-        item = model.Session.query(model.Resource)\
-               .filter("resource.id = '%s'" % resource_id)
-        if not item.count():
-            continue
-        items.append((item.first(), recent, ever))
-    return items
+    return connection.execute(text(sql), **params).fetchall()
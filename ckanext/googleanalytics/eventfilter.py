@@ -0,0 +1,104 @@
+import fnmatch
+import random
+import re
+
+# decisions are remembered for at most this many event names, as the names
+# come from request urls
+MAX_CACHED_NAMES = 1000
+
+
+def _split(value):
+    return [item for item in re.split(r'[\s,]+', value or '') if item]
+
+
+def _rate(key, item, value):
+    try:
+        rate = float(value)
+    except ValueError:
+        rate = None
+    if rate is None or not 0 <= rate <= 1:
+        raise ValueError('Invalid %s %r, the rate must be a number from 0 '
+                         'to 1' % (key, item))
+    return rate
+
+
+class ApiEventFilter(object):
+    """Decides which API calls are sent to Google Analytics as events.
+
+    Events are named after the action (``package_show``) or, for the REST
+    API, the register and function (``package_list``). ``allow`` and
+    ``deny`` are lists of shell style patterns: when ``allow`` is given
+    only matching events are sent, and events matching ``deny`` never are.
+    ``sample_rates`` is a list of ``(pattern, rate)`` pairs, the first
+    match giving the fraction of such events to send, otherwise
+    ``sample_rate``. Calls whose user agent contains one of
+    ``ignore_user_agents`` (case insensitive) are never sent.
+    """
+
+    def __init__(self, allow=(), deny=(), sample_rates=(), sample_rate=1.0,
+                 ignore_user_agents=()):
+        self.allow = list(allow)
+        self.deny = list(deny)
+        self.sample_rates = list(sample_rates)
+        self.sample_rate = sample_rate
+        self.ignore_user_agents = None
+        if ignore_user_agents:
+            self.ignore_user_agents = re.compile(
+                '|'.join(re.escape(agent) for agent in ignore_user_agents),
+                re.IGNORECASE)
+        self._rates = {}
+
+    @classmethod
+    def from_config(cls, config):
+        '''Build a filter from the ``googleanalytics.api_events.*``
+        settings. Every list is separated by whitespace or commas. Raises
+        ValueError, naming the setting, for an invalid value.'''
+        key = 'googleanalytics.api_events.sample_rates'
+        sample_rates = []
+        for item in _split(config.get(key)):
+            pattern, _, rate = item.rpartition(':')
+            if not pattern:
+                raise ValueError('Invalid %s %r, expected pattern:rate'
+                                 % (key, item))
+            sample_rates.append((pattern, _rate(key, item, rate)))
+        key = 'googleanalytics.api_events.sample_rate'
+        sample_rate = config.get(key, '1')
+        return cls(
+            allow=_split(config.get('googleanalytics.api_events.allow')),
+            deny=_split(config.get('googleanalytics.api_events.deny')),
+            sample_rates=sample_rates,
+            sample_rate=_rate(key, sample_rate, sample_rate),
+            ignore_user_agents=_split(config.get(
+                'googleanalytics.api_events.ignore_user_agents')))
+
+    def rate(self, name):
+        '''Return the fraction of ``name`` events to send.'''
+        rate = self._rates.get(name)
+        if rate is not None:
+            return rate
+        if self.allow and not any(fnmatch.fnmatchcase(name, pattern)
+                                  for pattern in self.allow):
+            rate = 0.0
+        elif any(fnmatch.fnmatchcase(name, pattern)
+                 for pattern in self.deny):
+            rate = 0.0
+        else:
+            rate = self.sample_rate
+            for pattern, pattern_rate in self.sample_rates:
+                if fnmatch.fnmatchcase(name, pattern):
+                    rate = pattern_rate
+                    break
+        if len(self._rates) < MAX_CACHED_NAMES:
+            self._rates[name] = rate
+        return rate
+
+    def accept(self, name, user_agent=None):
+        '''Whether this ``name`` event, from a client with ``user_agent``,
+        should be sent.'''
+        rate = self.rate(name)
+        if rate <= 0:
+            return False
+        if self.ignore_user_agents and user_agent and \
+                self.ignore_user_agents.search(user_agent):
+            return False
+        return rate >= 1 or random.random() < rate
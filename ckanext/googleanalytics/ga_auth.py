@@ -18,17 +18,29 @@ def _prepare_credentials(credentials_filename):
     return credentials
 
 
+def authorized_http(credentials_file):
+    """
+    Return a new httplib2.Http object authorized with the credentials in
+    credentials_file. httplib2.Http objects are not thread safe, so every
+    thread needs its own.
+    """
+    credentials = _prepare_credentials(credentials_file)
+    return credentials.authorize(httplib2.Http())
+
+
 def init_service(credentials_file):
     """
     Given a file containing the user's oauth token (and another with
     credentials in case we need to generate the token) will return a
     service object representing the analytics API.
     """
-    http = httplib2.Http()
-
-    credentials = _prepare_credentials(credentials_file)
-    http = credentials.authorize(http)  # authorize the http object
+    http = authorized_http(credentials_file)
 
+    # e.g. to use a mock of the API for load tests
+    discovery_url = config.get('googleanalytics.api_discovery_url')
+    if discovery_url:
+        return build('analytics', 'v3', http=http,
+                     discoveryServiceUrl=discovery_url)
     return build('analytics', 'v3', http=http)
 
 
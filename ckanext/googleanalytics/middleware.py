@@ -0,0 +1,122 @@
+import hashlib
+import logging
+import urlparse
+
+import plugin
+
+log = logging.getLogger('ckanext.googleanalytics')
+
+API_EVENT = "CKAN API Request"
+DOWNLOAD_EVENT = "CKAN Resource Download Request"
+# REST API controller actions that are tracked
+REST_FUNCTIONS = ('list', 'show', 'update', 'delete', 'search')
+
+
+class AnalyticsMiddleware(object):
+    """WSGI middleware sending API calls and resource downloads to Google
+    Analytics as events.
+
+    It is used instead of the GAApiController routes and the
+    resource_download wrapper when ``googleanalytics.api_tracking`` is
+    ``middleware``. The event is worked out from the routing match of the
+    request once the response has been sent. Ids are taken from the route,
+    the query string or form data that has already been parsed; request
+    bodies are never parsed again.
+    """
+
+    def __init__(self, app, googleanalytics_id):
+        self.app = app
+        self.googleanalytics_id = googleanalytics_id
+
+    def __call__(self, environ, start_response):
+        app_iter = self.app(environ, start_response)
+        return ClosingIterator(app_iter, lambda: self._track(environ))
+
+    def _track(self, environ):
+        try:
+            event = self._event(environ)
+            if event:
+                plugin.GoogleAnalyticsPlugin.analytics_sender.send(event)
+        except Exception, e:
+            log.debug(e)
+
+    def _event(self, environ):
+        routing_args = environ.get('wsgiorg.routing_args')
+        match = routing_args and routing_args[1]
+        if not match:
+            return None
+        action = match.get('action')
+        if action == 'resource_download':
+            return self._data_dict(environ, DOWNLOAD_EVENT,
+                                   'ResourceDownload',
+                                   match.get('resource_id'))
+        if match.get('controller') != 'api':
+            return None
+
+        if action == 'action':
+            name = category = match.get('logic_function')
+        elif action in REST_FUNCTIONS and match.get('register'):
+            category = match['register']
+            if match.get('subregister'):
+                category += '_' + match['subregister']
+            name = category + '_' + action
+            category += action
+        else:
+            return None
+        event_filter = plugin.GoogleAnalyticsPlugin.api_event_filter
+        if not event_filter.accept(name, environ.get('HTTP_USER_AGENT')):
+            return None
+        return self._data_dict(environ, API_EVENT, category,
+                               self._request_id(environ, match))
+
+    def _request_id(self, environ, match):
+        if match.get('id'):
+            return match['id']
+        params = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+        parsed_post = environ.get('webob._parsed_post_vars')
+        if parsed_post and hasattr(parsed_post[0], 'items'):
+            for key, value in parsed_post[0].items():
+                params.setdefault(key, [value])
+        for key in ('query', 'q', 'id'):
+            if params.get(key):
+                return params[key][0]
+        return ''
+
+    def _user(self, environ):
+        pylons = environ.get('pylons.pylons')
+        user = getattr(getattr(pylons, 'tmpl_context', None), 'user', None)
+        return user or environ.get('REMOTE_USER') or ''
+
+    def _data_dict(self, environ, event_type, action, label):
+        return {
+            "v": 1,
+            "tid": self.googleanalytics_id,
+            # customer id should be obfuscated
+            "cid": hashlib.md5(self._user(environ)).hexdigest(),
+            "t": "event",
+            "dh": environ.get('HTTP_HOST', ''),
+            "dp": environ.get('PATH_INFO', ''),
+            "dr": environ.get('HTTP_REFERER', ''),
+            "ec": event_type,
+            "ea": action,
+            "el": label or '',
+        }
+
+
+class ClosingIterator(object):
+    """Wraps a WSGI response iterable, calling ``callback`` after it has
+    been closed, i.e. once the response has been sent."""
+
+    def __init__(self, app_iter, callback):
+        self.app_iter = app_iter
+        self.callback = callback
+
+    def __iter__(self):
+        return iter(self.app_iter)
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            self.callback()
@@ -1,24 +1,126 @@
 import ast
+import atexit
+import errno
+import glob
 import logging
+import os
+import random
+import tempfile
 import urllib
+import cache
 import commands
+import dbutil
+from eventfilter import ApiEventFilter
+from middleware import AnalyticsMiddleware
+import jinja2
+import jinja2.meta
 import paste.deploy.converters as converters
-from ckan.lib.base import c
+from ckan.lib.base import c, request
 import ckan.lib.helpers as h
 import ckan.plugins as p
 from routes.mapper import SubMapper
 from pylons import config
 from ckan.controllers.package import PackageController
 
-import urllib2
+import requests
 import importlib
 import hashlib
 
 import threading
 import Queue
+import time
 
 log = logging.getLogger('ckanext.googleanalytics')
 
+DEFAULT_ENDPOINT_URL = "http://www.google-analytics.com/batch"
+DEFAULT_POOL_SIZE = 5
+# timeouts in seconds
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_READ_TIMEOUT = 10.0
+
+# Measurement Protocol batch limits, see
+# https://developers.google.com/analytics/devguides/collection/protocol/v1/devguide#batch-limitations
+BATCH_MAX_HITS = 20
+BATCH_MAX_BYTES = 16 * 1024
+HIT_MAX_BYTES = 8 * 1024
+DEFAULT_BATCH_LATENCY = 5.0
+
+# what to do with a hit when the analytics queue is full
+OVERFLOW_DROP_NEWEST = 'drop_newest'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_POLICIES = (OVERFLOW_DROP_NEWEST, OVERFLOW_DROP_OLDEST,
+                     OVERFLOW_BLOCK)
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_BLOCK_TIMEOUT = 0.1
+# log a warning on the first dropped hit and then every this many
+DROP_WARNING_INTERVAL = 1000
+
+# retries of a failed batch before it is spooled, delays in seconds
+DEFAULT_SEND_RETRIES = 3
+DEFAULT_RETRY_BACKOFF = 1.0
+DEFAULT_RETRY_BACKOFF_MAX = 60.0
+# hits queued for longer than this are discarded by Google Analytics, see
+# https://developers.google.com/analytics/devguides/collection/protocol/v1/parameters#qt
+MAX_QUEUE_TIME = 4 * 60 * 60
+
+DEFAULT_SENDER_THREADS = 5
+# seconds the sender threads get to empty the queue when the process exits
+DEFAULT_SHUTDOWN_TIMEOUT = 5.0
+# how often a thread waiting for its batch to fill up checks for a flush
+FLUSH_POLL_INTERVAL = 0.5
+
+# cached statistics, see controller.GAController and
+# GoogleAnalyticsPlugin.googleanalytics_resource_visits
+DEFAULT_CACHE_SIZE = 128
+DEFAULT_CACHE_TTL = 300
+# seconds before a worker checks whether loadanalytics has run again
+STATS_VERSION_TTL = 10
+
+# how API calls and resource downloads are captured
+API_TRACKING_CONTROLLER = 'controller'
+API_TRACKING_MIDDLEWARE = 'middleware'
+
+HEADER_SNIPPET = 'googleanalytics/snippets/googleanalytics_header.html'
+# rendered in place of the tracker fields, which can differ per request
+HEADER_FIELDS_MARKER = '__googleanalytics_fields__'
+# template globals that can differ between requests of the same language
+REQUEST_GLOBALS = frozenset(['c', 'h', 'request', 'session'])
+
+
+def uses_request_globals(env, name):
+    '''Whether the template name, or one it includes, extends or imports,
+    uses one of REQUEST_GLOBALS. Templates named by an expression can not
+    be checked, so count as using them.'''
+    names = [name]
+    seen = set()
+    while names:
+        name = names.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        source = env.loader.get_source(env, name)[0]
+        ast = env.parse(source)
+        if jinja2.meta.find_undeclared_variables(ast) & REQUEST_GLOBALS:
+            return True
+        for referenced in jinja2.meta.find_referenced_templates(ast):
+            if referenced is None:
+                return True
+            names.append(referenced)
+    return False
+
+
+def stats_version():
+    """Return the version of the saved statistics, checking for a new one
+    at most every STATS_VERSION_TTL seconds. Use it in the keys of
+    anything cached in GoogleAnalyticsPlugin.stats_cache."""
+    stats_cache = GoogleAnalyticsPlugin.stats_cache
+    version = stats_cache.get('stats_version', cache.MISSING)
+    if version is cache.MISSING:
+        version = dbutil.get_stats_version()
+        stats_cache.set('stats_version', version, ttl=STATS_VERSION_TTL)
+    return version
+
 
 def _post_analytics(
         user, event_type, request_obj_type, request_function, request_id):
@@ -37,7 +139,7 @@ def _post_analytics(
             "ea": request_obj_type + request_function,
             "el": request_id,
         }
-        GoogleAnalyticsPlugin.analytics_queue.put(data_dict)
+        GoogleAnalyticsPlugin.analytics_sender.send(data_dict)
 
 
 def wrap_resource_download(func):
@@ -56,33 +158,494 @@ def wrap_resource_download(func):
     return func_wrapper
 
 
+def _make_http_session(pool_size):
+    '''Return a requests session holding a pool of keep-alive connections
+    that is shared by all sender threads.'''
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
 class GoogleAnalyticsException(Exception):
     pass
 
 
+class AnalyticsQueue(Queue.Queue):
+    """Queue of hits waiting to be sent to Google Analytics
+
+    ``offer`` never lets the queue grow beyond ``maxsize``. What happens to
+    a hit that arrives while the queue is full depends on ``overflow``:
+
+    * ``drop_newest`` discards the new hit
+    * ``drop_oldest`` discards the oldest queued hit to make room
+    * ``block`` waits up to ``block_timeout`` seconds for room and then
+      discards the new hit
+
+    Discarded hits are counted in ``dropped``, see ``stats``.
+    """
+    def __init__(self, maxsize=0, overflow=OVERFLOW_DROP_NEWEST,
+                 block_timeout=DEFAULT_BLOCK_TIMEOUT):
+        if overflow not in OVERFLOW_POLICIES:
+            raise GoogleAnalyticsException(
+                "Unknown queue overflow policy %r, expected one of %s"
+                % (overflow, ', '.join(OVERFLOW_POLICIES)))
+        Queue.Queue.__init__(self, maxsize)
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+
+    def _count_dropped(self):
+        with self._dropped_lock:
+            self.dropped += 1
+            dropped = self.dropped
+        if dropped == 1 or dropped % DROP_WARNING_INTERVAL == 0:
+            log.warning("Analytics queue is full (%s hits), %s hits dropped "
+                        "so far using policy %s"
+                        % (self.maxsize, dropped, self.overflow))
+
+    def offer(self, item):
+        '''Queue ``item`` according to the overflow policy. Returns False if
+        the item itself was dropped.'''
+        if self.overflow == OVERFLOW_BLOCK:
+            try:
+                self.put(item, True, self.block_timeout)
+                return True
+            except Queue.Full:
+                self._count_dropped()
+                return False
+
+        while True:
+            try:
+                self.put_nowait(item)
+                return True
+            except Queue.Full:
+                if self.overflow == OVERFLOW_DROP_NEWEST:
+                    self._count_dropped()
+                    return False
+            try:
+                self.get_nowait()
+            except Queue.Empty:
+                # a sender thread made room in the meantime
+                continue
+            self.task_done()
+            self._count_dropped()
+
+    def stats(self):
+        '''Return a dict with the current size, capacity and number of
+        dropped hits, for sizing the queue.'''
+        return {
+            'size': self.qsize(),
+            'maxsize': self.maxsize,
+            'overflow': self.overflow,
+            'dropped': self.dropped,
+        }
+
+
+class AnalyticsSpool(object):
+    """Append-only file of hits that could not be sent
+
+    Every line holds the time a hit was spooled and its encoded payload.
+    ``replay`` first renames the file to a name private to the current
+    process, so concurrent workers never send the same hits twice.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._write_lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+
+    def append(self, batch):
+        spooled = int(time.time())
+        self._append_lines(
+            ''.join('%d\t%s\n' % (spooled, data) for data in batch))
+
+    def _append_lines(self, lines):
+        # a single unbuffered write to a file opened with O_APPEND, so
+        # that lines appended by other processes are not interleaved
+        with self._write_lock:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                         0644)
+            try:
+                while lines:
+                    lines = lines[os.write(fd, lines):]
+            finally:
+                os.close(fd)
+
+    def pending(self):
+        try:
+            return os.path.getsize(self.path) > 0
+        except OSError:
+            return False
+
+    def _claim(self):
+        '''Rename the spool file, or one that a dead process was replaying,
+        to a name private to this process. Returns None if there is nothing
+        to replay.'''
+        claimed = '%s.%s.replay' % (self.path, os.getpid())
+        if os.path.exists(claimed):
+            return claimed
+        for orphan in glob.glob('%s.*.replay' % self.path):
+            pid = orphan[len(self.path) + 1:-len('.replay')]
+            try:
+                os.kill(int(pid), 0)
+                continue
+            except ValueError:
+                continue
+            except OSError, e:
+                if e.errno != errno.ESRCH:
+                    continue
+            try:
+                os.rename(orphan, claimed)
+                return claimed
+            except OSError:
+                pass
+        try:
+            os.rename(self.path, claimed)
+            return claimed
+        except OSError:
+            return None
+
+    def _replay_file(self, claimed, send, batch_size):
+        sent = expired = malformed = 0
+        now = int(time.time())
+        failed = False
+        with open(claimed) as f:
+            batch = []
+            size = 0
+            # readline rather than iteration, so that the rest of the file
+            # can be read in one go if sending fails
+            for line in iter(f.readline, ''):
+                spooled, _, data = line.rstrip('\n').partition('\t')
+                try:
+                    age = now - int(spooled)
+                except ValueError:
+                    data = None
+                if not data or not line.endswith('\n'):
+                    malformed += 1
+                    continue
+                if age > MAX_QUEUE_TIME:
+                    expired += 1
+                    continue
+                # tell Google Analytics when the hit really happened
+                data = '%s&qt=%d' % (data, age * 1000)
+                if batch and (len(batch) == batch_size or
+                              size + len(data) + 1 > BATCH_MAX_BYTES):
+                    if not send([d for l, d in batch]):
+                        self._append_lines(''.join(
+                            [l for l, d in batch] + [line, f.read()]))
+                        failed = True
+                        batch = []
+                        break
+                    sent += len(batch)
+                    batch = []
+                    size = 0
+                batch.append((line, data))
+                size += len(data) + 1
+            if batch:
+                if send([d for l, d in batch]):
+                    sent += len(batch)
+                else:
+                    self._append_lines(''.join(l for l, d in batch))
+                    failed = True
+        os.remove(claimed)
+        if malformed:
+            log.warning("Skipped %s malformed lines of the analytics spool"
+                        % malformed)
+        if expired:
+            log.warning("Discarded %s spooled analytics hits older than "
+                        "%s seconds" % (expired, MAX_QUEUE_TIME))
+        return sent, failed
+
+    def replay(self, send, batch_size=BATCH_MAX_HITS):
+        '''Send spooled hits in batches with ``send``, which must return
+        True on success. The first failed batch and everything after it
+        is put back into the spool. Returns the number of hits sent.'''
+        if not self._replay_lock.acquire(False):
+            # another thread is already replaying
+            return 0
+        try:
+            total = 0
+            while True:
+                claimed = self._claim()
+                if not claimed:
+                    break
+                sent, failed = self._replay_file(claimed, send, batch_size)
+                total += sent
+                if failed:
+                    break
+            if total:
+                log.info("Replayed %s spooled analytics hits" % total)
+            return total
+        finally:
+            self._replay_lock.release()
+
+
 class AnalyticsPostThread(threading.Thread):
-    """Threaded Url POST"""
-    def __init__(self, queue):
+    """Threaded Url POST
+
+    Hits are taken off the queue and grouped into Measurement Protocol
+    ``/batch`` requests. A batch is sent as soon as it is full or when
+    ``batch_latency`` seconds have passed since its first hit was taken.
+    Requests go through ``session`` so that connections are kept alive
+    between batches.
+
+    A batch that fails is retried ``retries`` times with exponential
+    backoff. If it still fails it is written to ``spool`` and sending
+    pauses for ``retry_backoff_max`` seconds, during which new batches go
+    straight to the spool. Spooled hits are replayed after the next
+    successful send.
+
+    While ``flushing`` is set the thread does not wait for batches to fill
+    up and failed batches are spooled without being retried.
+    """
+    # time until which batches are spooled without trying to send them,
+    # shared by all sender threads
+    _suspended_until = 0
+
+    def __init__(self, queue, session=None,
+                 endpoint_url=DEFAULT_ENDPOINT_URL,
+                 timeout=(DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT),
+                 batch_size=BATCH_MAX_HITS,
+                 batch_latency=DEFAULT_BATCH_LATENCY,
+                 retries=DEFAULT_SEND_RETRIES,
+                 retry_backoff=DEFAULT_RETRY_BACKOFF,
+                 retry_backoff_max=DEFAULT_RETRY_BACKOFF_MAX,
+                 spool=None, flushing=None):
         threading.Thread.__init__(self)
         self.queue = queue
+        self.session = session or _make_http_session(1)
+        self.endpoint_url = endpoint_url
+        self.timeout = timeout
+        self.batch_size = max(1, min(batch_size, BATCH_MAX_HITS))
+        self.batch_latency = batch_latency
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.retry_backoff_max = retry_backoff_max
+        self.spool = spool
+        self.flushing = flushing or threading.Event()
+        # encoded hit that did not fit into the previous batch
+        self._carry = None
+
+    def _next_hit(self, block=True, timeout=None):
+        data_dict = self.queue.get(block, timeout)
+        try:
+            data = urllib.urlencode(data_dict)
+        except Exception, e:
+            log.warning("Dropping Google Analytics hit that cannot be "
+                        "encoded: %s" % e)
+            self.queue.task_done()
+            return None
+        if len(data) > HIT_MAX_BYTES:
+            log.warning("Dropping Google Analytics hit larger than %s bytes"
+                        % HIT_MAX_BYTES)
+            self.queue.task_done()
+            return None
+        return data
+
+    def _next_batch(self):
+        '''Block until a hit is available, then keep collecting hits until
+        the batch is full or the latency deadline has passed.'''
+        batch = []
+        size = 0
+        deadline = None
+        while len(batch) < self.batch_size:
+            if self._carry is not None:
+                data, self._carry = self._carry, None
+            elif deadline is None:
+                data = self._next_hit()
+            elif self.flushing.is_set():
+                # take what is queued but do not wait for more
+                try:
+                    data = self._next_hit(False)
+                except Queue.Empty:
+                    break
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    data = self._next_hit(
+                        True, min(remaining, FLUSH_POLL_INTERVAL))
+                except Queue.Empty:
+                    continue
+            if data is None:
+                continue
+            # hits in a batch payload are separated by newlines
+            if batch and size + len(data) + 1 > BATCH_MAX_BYTES:
+                self._carry = data
+                break
+            batch.append(data)
+            size += len(data) + 1
+            if deadline is None:
+                deadline = time.time() + self.batch_latency
+        return batch
+
+    def _send(self, batch):
+        data = '\n'.join(batch)
+        log.debug("Sending %s API events to Google Analytics: %s"
+                  % (len(batch), data))
+        response = self.session.post(
+            self.endpoint_url, data=data, timeout=self.timeout)
+        response.raise_for_status()
+
+    def _try_send(self, batch):
+        try:
+            self._send(batch)
+            return True
+        except Exception, e:
+            log.warning("Sending %s hits to Google Analytics failed: %s"
+                        % (len(batch), e))
+            return False
+
+    def _send_with_retry(self, batch):
+        delay = self.retry_backoff
+        retries = 0 if self.flushing.is_set() else self.retries
+        for attempt in range(retries + 1):
+            if attempt:
+                # jittered, so that threads and processes that failed
+                # together do not all retry at the same moment
+                time.sleep(random.uniform(delay / 2, delay))
+                delay = min(delay * 2, self.retry_backoff_max)
+            if self._try_send(batch):
+                return True
+        return False
+
+    def _deliver(self, batch):
+        if time.time() < AnalyticsPostThread._suspended_until and self.spool:
+            self.spool.append(batch)
+            return
+        if self._send_with_retry(batch):
+            if (self.spool and not self.flushing.is_set() and
+                    self.spool.pending()):
+                self.spool.replay(self._try_send, self.batch_size)
+            return
+        AnalyticsPostThread._suspended_until = (
+            time.time() + self.retry_backoff_max)
+        if self.spool:
+            log.error("Google Analytics unreachable, spooling %s hits to %s"
+                      % (len(batch), self.spool.path))
+            self.spool.append(batch)
+        else:
+            log.error("Google Analytics unreachable, dropping %s hits"
+                      % len(batch))
 
     def run(self):
         while True:
-            # grabs host from queue
-            data_dict = self.queue.get()
-
-            data = urllib.urlencode(data_dict)
-            log.debug("Sending API event to Google Analytics: " + data)
-            # send analytics
-            urllib2.urlopen(
-                "http://www.google-analytics.com/collect",
-                data,
-                # timeout in seconds
-                # https://docs.python.org/2/library/urllib2.html#urllib2.urlopen
-                10)
-
-            # signals to queue job is done
-            self.queue.task_done()
+            batch = []
+            try:
+                batch = self._next_batch()
+                if batch:
+                    # send analytics
+                    self._deliver(batch)
+            except Exception, e:
+                # never let the thread die, the pool would silently shrink
+                log.exception(e)
+            finally:
+                # signals to queue the jobs are done
+                for i in range(len(batch)):
+                    self.queue.task_done()
+
+
+class AnalyticsSender(object):
+    """Pool of AnalyticsPostThreads sending the hits offered to ``queue``
+
+    The threads are started by the first ``send`` in each process rather
+    than when the plugin is configured. Pre-forking servers load the plugin
+    in the master process and threads started there do not survive the
+    fork into the workers, so every worker starts its own pool exactly once.
+
+    An atexit hook gives the threads ``shutdown_timeout`` seconds to send
+    what is still queued; whatever is left after that goes to the spool.
+    """
+    def __init__(self, queue, threads=DEFAULT_SENDER_THREADS,
+                 shutdown_timeout=DEFAULT_SHUTDOWN_TIMEOUT, **thread_options):
+        self.queue = queue
+        self.threads = threads
+        self.shutdown_timeout = shutdown_timeout
+        self.thread_options = thread_options
+        self.flushing = threading.Event()
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        '''Start the sender threads unless this process already has them.'''
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            for i in range(self.threads):
+                t = AnalyticsPostThread(
+                    self.queue, flushing=self.flushing,
+                    **self.thread_options)
+                t.setDaemon(True)
+                t.start()
+            self._pid = pid
+            atexit.register(self.flush)
+            log.debug("Started %s analytics sender threads in process %s"
+                      % (self.threads, pid))
+
+    def send(self, data_dict):
+        '''Queue a hit, starting the threads first if needed. Returns False
+        if the queue was full and the hit was dropped.'''
+        self.start()
+        return self.queue.offer(data_dict)
+
+    def flush(self, timeout=None):
+        '''Wait up to ``timeout`` seconds (``shutdown_timeout`` by default)
+        for the queue to be sent. Returns True if it was emptied in time.'''
+        if self._pid != os.getpid():
+            # the threads, if any, belong to another process
+            return True
+        if timeout is None:
+            timeout = self.shutdown_timeout
+        deadline = time.time() + timeout
+        self.flushing.set()
+        try:
+            with self.queue.all_tasks_done:
+                while self.queue.unfinished_tasks:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.queue.all_tasks_done.wait(remaining)
+            if not self.queue.unfinished_tasks:
+                return True
+            self._spool_remaining()
+            return False
+        finally:
+            self.flushing.clear()
+
+    def _spool_remaining(self):
+        spool = self.thread_options.get('spool')
+        batch = []
+        while True:
+            try:
+                data_dict = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                batch.append(urllib.urlencode(data_dict))
+            except Exception:
+                pass
+            finally:
+                self.queue.task_done()
+        if batch and spool:
+            log.warning("Spooling %s analytics hits not sent before shutdown"
+                        % len(batch))
+            spool.append(batch)
+        elif batch:
+            log.warning("Dropping %s analytics hits not sent before shutdown"
+                        % len(batch))
 
 
 class GoogleAnalyticsPlugin(p.SingletonPlugin):
@@ -90,8 +653,13 @@ class GoogleAnalyticsPlugin(p.SingletonPlugin):
     p.implements(p.IRoutes, inherit=True)
     p.implements(p.IConfigurer, inherit=True)
     p.implements(p.ITemplateHelpers)
+    p.implements(p.IMiddleware, inherit=True)
 
-    analytics_queue = Queue.Queue()
+    analytics_queue = AnalyticsQueue()
+    analytics_sender = AnalyticsSender(analytics_queue)
+    stats_cache = cache.TTLCache(DEFAULT_CACHE_SIZE, DEFAULT_CACHE_TTL)
+    api_event_filter = ApiEventFilter()
+    api_tracking = API_TRACKING_CONTROLLER
 
     def configure(self, config):
         '''Load config settings for this extension from config file.
@@ -118,6 +686,13 @@ class GoogleAnalyticsPlugin(p.SingletonPlugin):
         if self.googleanalytics_linked_domains:
             self.googleanalytics_fields['allowLinker'] = 'true'
 
+        # unless its template depends on the request, the header only
+        # varies by the tracker fields and the language, so it is rendered
+        # once per language and the fields spliced in for each request
+        self._header_parts = {}
+        self._header_per_request = None
+        self._header_fields = str(self.googleanalytics_fields)
+
         self.googleanalytics_javascript_url = h.url_for_static(
                 '/scripts/ckanext-googleanalytics.js')
 
@@ -131,21 +706,75 @@ class GoogleAnalyticsPlugin(p.SingletonPlugin):
             'googleanalytics_resource_prefix']
 
         self.show_downloads = converters.asbool(
-            config.get('googleanalytics.show_downloads', True))
+            config.get('googleanalytics.show_downloads', False))
         self.track_events = converters.asbool(
             config.get('googleanalytics.track_events', False))
         self.enable_user_id = converters.asbool(
             config.get('googleanalytics.enable_user_id', False))
+        self.api_tracking = config.get('googleanalytics.api_tracking',
+                                       API_TRACKING_CONTROLLER)
+        if self.api_tracking not in (API_TRACKING_CONTROLLER,
+                                     API_TRACKING_MIDDLEWARE):
+            raise GoogleAnalyticsException(
+                "Unknown googleanalytics.api_tracking %r, expected %s or %s"
+                % (self.api_tracking, API_TRACKING_CONTROLLER,
+                   API_TRACKING_MIDDLEWARE))
 
         if not converters.asbool(config.get('ckan.legacy_templates', 'false')):
             p.toolkit.add_resource('fanstatic_library', 'ckanext-googleanalytics')
 
-            # spawn a pool of 5 threads, and pass them queue instance
-        for i in range(5):
-            t = AnalyticsPostThread(self.analytics_queue)
-            t.setDaemon(True)
-            t.start()
-
+        queue = AnalyticsQueue(
+            int(config.get('googleanalytics.queue_size', DEFAULT_QUEUE_SIZE)),
+            config.get('googleanalytics.queue_overflow', OVERFLOW_DROP_NEWEST),
+            float(config.get('googleanalytics.queue_block_timeout',
+                             DEFAULT_BLOCK_TIMEOUT)))
+
+        spool_path = config.get('googleanalytics.spool_path')
+        if spool_path is None:
+            spool_path = os.path.join(
+                config.get('cache_dir') or tempfile.gettempdir(),
+                'googleanalytics_spool')
+
+        # the sender threads are only started by the first event sent from
+        # each process, see AnalyticsSender
+        GoogleAnalyticsPlugin.analytics_queue = queue
+        GoogleAnalyticsPlugin.analytics_sender = AnalyticsSender(
+            queue,
+            threads=int(config.get('googleanalytics.sender_threads',
+                                   DEFAULT_SENDER_THREADS)),
+            shutdown_timeout=float(config.get(
+                'googleanalytics.shutdown_timeout', DEFAULT_SHUTDOWN_TIMEOUT)),
+            session=_make_http_session(int(config.get(
+                'googleanalytics.http_pool_size', DEFAULT_POOL_SIZE))),
+            endpoint_url=config.get(
+                'googleanalytics.endpoint_url', DEFAULT_ENDPOINT_URL),
+            timeout=(
+                float(config.get('googleanalytics.connect_timeout',
+                                 DEFAULT_CONNECT_TIMEOUT)),
+                float(config.get('googleanalytics.read_timeout',
+                                 DEFAULT_READ_TIMEOUT))),
+            batch_size=int(config.get(
+                'googleanalytics.batch_size', BATCH_MAX_HITS)),
+            batch_latency=float(config.get(
+                'googleanalytics.batch_latency', DEFAULT_BATCH_LATENCY)),
+            retries=int(config.get('googleanalytics.send_retries',
+                                   DEFAULT_SEND_RETRIES)),
+            retry_backoff=float(config.get(
+                'googleanalytics.retry_backoff', DEFAULT_RETRY_BACKOFF)),
+            retry_backoff_max=float(config.get(
+                'googleanalytics.retry_backoff_max',
+                DEFAULT_RETRY_BACKOFF_MAX)),
+            spool=AnalyticsSpool(spool_path) if spool_path else None)
+
+        try:
+            GoogleAnalyticsPlugin.api_event_filter = \
+                ApiEventFilter.from_config(config)
+        except ValueError, e:
+            raise GoogleAnalyticsException(str(e))
+
+        GoogleAnalyticsPlugin.stats_cache = cache.TTLCache(
+            int(config.get('googleanalytics.cache_size', DEFAULT_CACHE_SIZE)),
+            float(config.get('googleanalytics.cache_ttl', DEFAULT_CACHE_TTL)))
 
     def update_config(self, config):
         '''Change the CKAN (Pylons) environment configuration.
@@ -165,6 +794,10 @@ class GoogleAnalyticsPlugin(p.SingletonPlugin):
         See IRoutes.
 
         '''
+        if self.api_tracking == API_TRACKING_MIDDLEWARE:
+            # API calls are captured by AnalyticsMiddleware instead
+            return map
+
         # Helpers to reduce code clutter
         GET = dict(method=['GET'])
         PUT = dict(method=['PUT'])
@@ -217,7 +850,8 @@ class GoogleAnalyticsPlugin(p.SingletonPlugin):
         See IRoutes.
 
         '''
-        self.modify_resource_download_route(map)
+        if self.api_tracking == API_TRACKING_CONTROLLER:
+            self.modify_resource_download_route(map)
         map.redirect("/analytics/package/top", "/analytics/dataset/top")
         map.connect(
             'analytics', '/analytics/dataset/top',
@@ -226,13 +860,48 @@ class GoogleAnalyticsPlugin(p.SingletonPlugin):
         )
         return map
 
+    def make_middleware(self, app, config):
+        '''Wrap the app with AnalyticsMiddleware if API calls are tracked
+        by middleware.
+
+        See IMiddleware.
+
+        '''
+        if config.get('googleanalytics.api_tracking') == \
+                API_TRACKING_MIDDLEWARE:
+            return AnalyticsMiddleware(app, config['googleanalytics.id'])
+        return app
+
     def get_helpers(self):
         '''Return the CKAN 2.0 template helper functions this plugin provides.
 
         See ITemplateHelpers.
 
         '''
-        return {'googleanalytics_header': self.googleanalytics_header}
+        return {'googleanalytics_header': self.googleanalytics_header,
+                'googleanalytics_show_downloads':
+                    self.googleanalytics_show_downloads,
+                'googleanalytics_resource_visits':
+                    self.googleanalytics_resource_visits}
+
+    def googleanalytics_show_downloads(self):
+        '''Whether resource download counts should be displayed.'''
+        return self.show_downloads
+
+    def googleanalytics_resource_visits(self, package_id):
+        '''Return a dict of the download counts of a package's resources,
+        by resource id.
+
+        All of the package's counts are read with one query and cached, so
+        rendering a list of resources costs at most one query.
+
+        '''
+        key = ('resource_visits', stats_version(), package_id)
+        visits = self.stats_cache.get(key)
+        if visits is None:
+            visits = dbutil.get_resource_visits_for_package(package_id)
+            self.stats_cache.set(key, visits)
+        return visits
 
     def googleanalytics_header(self):
         '''Render the googleanalytics_header snippet for CKAN 2.0 templates.
@@ -243,17 +912,68 @@ class GoogleAnalyticsPlugin(p.SingletonPlugin):
 
         '''
 
+        # never store the user's id in the shared fields, other users'
+        # pages would get it
+        fields = self._header_fields
         if self.enable_user_id and c.user:
-            self.googleanalytics_fields['userId'] = str(c.userobj.id)
-
-        data = {
+            fields = str(dict(self.googleanalytics_fields,
+                              userId=str(c.userobj.id)))
+        if self._header_per_request is None:
+            self._header_per_request = self._header_uses_request()
+        if self._header_per_request:
+            return self._render_snippet(fields)
+        lang = request.environ.get('CKAN_LANG')
+        parts = self._header_parts.get(lang)
+        if parts is None:
+            parts = self._header_parts[lang] = self._render_header()
+        if not parts:
+            return self._render_snippet(fields)
+        prefix, suffix = parts
+        return h.literal(prefix + fields + suffix)
+
+    def _render_snippet(self, fields):
+        return p.toolkit.render_snippet(HEADER_SNIPPET, {
             'googleanalytics_id': self.googleanalytics_id,
             'googleanalytics_domain': self.googleanalytics_domain,
-            'googleanalytics_fields': str(self.googleanalytics_fields),
-            'googleanalytics_linked_domains': self.googleanalytics_linked_domains
-        }
-        return p.toolkit.render_snippet(
-            'googleanalytics/snippets/googleanalytics_header.html', data)
+            'googleanalytics_fields': fields,
+            'googleanalytics_linked_domains':
+                self.googleanalytics_linked_domains,
+        })
+
+    def _header_uses_request(self):
+        '''Whether the googleanalytics_header template, or a theme's
+        override of it, uses globals that can differ between requests.
+
+        '''
+        try:
+            env = config['pylons.app_globals'].jinja_env
+            uses_request = uses_request_globals(env, HEADER_SNIPPET)
+        except (KeyError, AttributeError, jinja2.TemplateError), e:
+            log.warning("Could not check the googleanalytics header "
+                        "template, it will be rendered for every page: %s", e)
+            return True
+        if uses_request:
+            log.info("The googleanalytics header template depends on the "
+                     "request, it will be rendered for every page")
+        return uses_request
+
+    def _render_header(self):
+        '''Render the googleanalytics_header snippet, with CKAN's renderer
+        so that theme overrides work as before, with a marker in place of
+        the tracker fields, in the language of the current request.
+        Returns the parts before and after the marker, or () if a template
+        does not show the fields exactly once, in which case the snippet
+        is rendered for every request.
+
+        '''
+        parts = unicode(self._render_snippet(HEADER_FIELDS_MARKER)).split(
+            HEADER_FIELDS_MARKER)
+        if len(parts) != 2:
+            log.warning("The googleanalytics header template does not show "
+                        "googleanalytics_fields exactly once, it will be "
+                        "rendered for every page")
+            return ()
+        return tuple(parts)
 
     def modify_resource_download_route(self, map):
         '''Modifies resource_download method in related controller
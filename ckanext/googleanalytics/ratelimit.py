@@ -0,0 +1,128 @@
+import json
+import logging
+import random
+import threading
+import time
+
+log = logging.getLogger('ckanext.googleanalytics')
+
+# statuses worth retrying; a 403 only when Google says it is about quota
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded',
+                      'quotaExceeded', 'backendError')
+
+
+class TokenBucket(object):
+    """Thread safe token bucket allowing ``rate`` calls per second on
+    average and bursts of up to ``burst`` calls.
+
+    The rate drops to half of its value each time ``slow_down`` is called
+    and climbs back to the configured rate as calls succeed again.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.max_rate = float(rate)
+        self.rate = self.max_rate
+        self.burst = max(float(burst), 1.0)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.waited = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Take a token, sleeping until one is available. Returns the
+        number of seconds spent waiting."""
+        with self._lock:
+            self._refill(time.time())
+            # the token is reserved now, so that callers queue up in order
+            # rather than all waking up for the same token
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.waited += wait
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def slow_down(self):
+        with self._lock:
+            self._refill(time.time())
+            self.rate = max(self.rate / 2, self.max_rate / 64)
+            log.info('Google Analytics rate limited us, slowing down to '
+                     '%.2f requests per second' % self.rate)
+
+    def speed_up(self):
+        with self._lock:
+            if self.rate < self.max_rate:
+                self._refill(time.time())
+                self.rate = min(self.rate + self.max_rate / 16, self.max_rate)
+
+
+def is_retryable(error):
+    """Whether ``error``, usually an ``apiclient.errors.HttpError``, is a
+    transient or rate limit error worth retrying."""
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    try:
+        status = int(status)
+    except (TypeError, ValueError):
+        return False
+    if status in RETRY_STATUSES:
+        return True
+    return status == 403 and _reason(error) in RATE_LIMIT_REASONS
+
+
+def _reason(error):
+    try:
+        content = json.loads(error.content)
+        return content['error']['errors'][0]['reason']
+    except (AttributeError, KeyError, IndexError, TypeError, ValueError):
+        return None
+
+
+class RateLimiter(object):
+    """Calls functions through a ``TokenBucket``, retrying them with
+    exponential backoff and full jitter when ``is_retryable`` says so.
+
+    ``waited`` and ``backed_off`` hold the seconds spent waiting for a
+    token and backing off after errors respectively.
+    """
+
+    def __init__(self, rate, burst=1, retries=5, backoff=1.0,
+                 backoff_max=32.0):
+        self.bucket = TokenBucket(rate, burst)
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.backed_off = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def waited(self):
+        return self.bucket.waited
+
+    def call(self, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if attempt >= self.retries or not is_retryable(e):
+                    raise
+                if int(e.resp.status) in (403, 429):
+                    self.bucket.slow_down()
+                delay = random.uniform(
+                    0, min(self.backoff * 2 ** attempt, self.backoff_max))
+                log.warning('Google Analytics request failed (%s), retrying '
+                            'in %.1f seconds' % (e, delay))
+                with self._lock:
+                    self.backed_off += delay
+                time.sleep(delay)
+                attempt += 1
+            else:
+                self.bucket.speed_up()
+                return result
@@ -1,6 +1,18 @@
 import os
+import re
+import json
+import time
+import random
+import datetime
+import optparse
+import urllib
+import urlparse
 import BaseHTTPServer
+import SocketServer
 import threading
+from collections import OrderedDict
+
+from synthetic import package_url, resource_url, RESOURCES_PER_PACKAGE
 
 here_dir = os.path.dirname(os.path.abspath(__file__))
 
@@ -60,3 +72,539 @@ def runmockserver():
     httpd_thread.setDaemon(True)
     httpd_thread.start()
     return httpd_thread
+
+
+# A mock of the Core Reporting API v3, as used by loadanalytics through
+# apiclient: the discovery document, the management endpoints that
+# get_profile_id uses, data.ga.get and an OAuth token endpoint.
+
+DISCOVERY_PATH = '/discovery/v1/apis/analytics/v3/rest'
+DISCOVERY_URL = '/discovery/v1/apis/{api}/{apiVersion}/rest'
+GA_MAX_RESULTS = 10000
+DEFAULT_MAX_RESULTS = 1000
+DIMENSIONS = ('ga:date', 'ga:pagePath')
+FILTER_REGEX = re.compile(r'^(ga:\w+)(==|!=|=~|!~|=@|!@)(.*)$')
+
+
+def _param(location='query', type='string', required=False, **extra):
+    param = {'location': location, 'type': type}
+    if required:
+        param['required'] = True
+    param.update(extra)
+    return param
+
+
+def _property(type='string', **extra):
+    return dict(extra, type=type)
+
+
+def _schema(schema_id, **properties):
+    return {'id': schema_id, 'type': 'object', 'properties': properties}
+
+
+def _list_schema(schema_id, item):
+    """The schema of a management list of item"""
+    return _schema(schema_id, kind=_property(), username=_property(),
+                   totalResults=_property('integer', format='int32'),
+                   startIndex=_property('integer', format='int32'),
+                   itemsPerPage=_property('integer', format='int32'),
+                   items={'type': 'array', 'items': {'$ref': item}})
+
+
+# the parts of the responses that loadanalytics reads
+SCHEMAS = {
+    'Account': _schema('Account', id=_property(), kind=_property(),
+                       name=_property()),
+    'Accounts': _list_schema('Accounts', 'Account'),
+    'Webproperty': _schema('Webproperty', id=_property(), kind=_property(),
+                           accountId=_property(), name=_property()),
+    'Webproperties': _list_schema('Webproperties', 'Webproperty'),
+    'Profile': _schema('Profile', id=_property(), kind=_property(),
+                       accountId=_property(), webPropertyId=_property(),
+                       name=_property()),
+    'Profiles': _list_schema('Profiles', 'Profile'),
+    'GaData': _schema(
+        'GaData', kind=_property(), id=_property(),
+        selfLink=_property(), nextLink=_property(),
+        itemsPerPage=_property('integer', format='int32'),
+        totalResults=_property('integer', format='int32'),
+        containsSampledData=_property('boolean'),
+        sampleSize=_property(format='int64'),
+        sampleSpace=_property(format='int64'),
+        rows={'type': 'array',
+              'items': {'type': 'array', 'items': {'type': 'string'}}}),
+}
+
+
+def discovery_document(root_url):
+    """A discovery document with just the methods loadanalytics calls"""
+    def method(id, path, parameters, order, response):
+        # without a response schema apiclient returns the raw json
+        return {'id': 'analytics.' + id, 'path': path, 'httpMethod': 'GET',
+                'parameters': parameters, 'parameterOrder': order,
+                'response': {'$ref': response}}
+    account = _param('path', required=True)
+    web_property = _param('path', required=True)
+    page = {'max-results': _param(type='integer', format='int32'),
+            'start-index': _param(type='integer', format='int32')}
+    return {
+        'kind': 'discovery#restDescription',
+        'discoveryVersion': 'v1',
+        'id': 'analytics:v3',
+        'name': 'analytics',
+        'version': 'v3',
+        'protocol': 'rest',
+        'rootUrl': root_url,
+        'servicePath': 'analytics/v3/',
+        'baseUrl': root_url + 'analytics/v3/',
+        'basePath': '/analytics/v3/',
+        'batchPath': 'batch/analytics/v3',
+        'parameters': {'alt': _param(default='json', enum=['json']),
+                       'fields': _param(),
+                       'quotaUser': _param(),
+                       'userIp': _param()},
+        'resources': {
+            'management': {'resources': {
+                'accounts': {'methods': {'list': method(
+                    'management.accounts.list', 'management/accounts',
+                    page, [], 'Accounts')}},
+                'webproperties': {'methods': {'list': method(
+                    'management.webproperties.list',
+                    'management/accounts/{accountId}/webproperties',
+                    dict(page, accountId=account), ['accountId'],
+                    'Webproperties')}},
+                'profiles': {'methods': {'list': method(
+                    'management.profiles.list',
+                    'management/accounts/{accountId}/webproperties/'
+                    '{webPropertyId}/profiles',
+                    dict(page, accountId=account,
+                         webPropertyId=web_property),
+                    ['accountId', 'webPropertyId'], 'Profiles')}},
+            }},
+            'data': {'resources': {'ga': {'methods': {'get': method(
+                'data.ga.get', 'data/ga',
+                dict(page,
+                     ids=_param(required=True),
+                     metrics=_param(required=True),
+                     dimensions=_param(),
+                     filters=_param(),
+                     segment=_param(),
+                     sort=_param(),
+                     samplingLevel=_param(),
+                     output=_param(),
+                     **{'start-date': _param(required=True),
+                        'end-date': _param(required=True),
+                        'include-empty-rows': _param(type='boolean')}),
+                ['ids', 'start-date', 'end-date', 'metrics'],
+                'GaData')}}}},
+        },
+        'schemas': SCHEMAS,
+    }
+
+
+class ApiError(Exception):
+    def __init__(self, code, reason, message):
+        super(ApiError, self).__init__(message)
+        self.code = code
+        self.reason = reason
+        self.message = message
+
+    def content(self):
+        error = {'domain': 'global', 'reason': self.reason,
+                 'message': self.message}
+        if self.code == 403:
+            error['domain'] = 'usageLimits'
+        return {'error': {'errors': [error], 'code': self.code,
+                          'message': self.message}}
+
+
+def _parse_date(value):
+    today = datetime.date.today()
+    if value == 'today':
+        return today
+    if value == 'yesterday':
+        return today - datetime.timedelta(1)
+    match = re.match(r'^(\d+)daysAgo$', value)
+    if match:
+        return today - datetime.timedelta(int(match.group(1)))
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise ApiError(400, 'invalidParameter',
+                       'Invalid value %r for a date' % value)
+
+
+def _matches(row, filters):
+    """Whether row matches a filters expression: ';' separated conditions
+    that must all hold, each a ',' separated list of alternatives."""
+    for condition in filters.split(';'):
+        for alternative in condition.split(','):
+            match = FILTER_REGEX.match(alternative)
+            if not match:
+                raise ApiError(400, 'invalidParameter',
+                               'Invalid filter %r' % alternative)
+            name, operator, operand = match.groups()
+            value = row.get(name)
+            if value is None:
+                raise ApiError(400, 'invalidParameter',
+                               'Unknown dimension %s in filters' % name)
+            if operator[0] == '!':
+                negate, operator = True, '=' + operator[1]
+            else:
+                negate = False
+            if operator == '==':
+                found = value == operand
+            elif operator == '=~':
+                found = re.search(operand, value) is not None
+            else:
+                found = operand in value
+            if found != negate:
+                break
+        else:
+            return False
+    return True
+
+
+class MockReportingAPI(object):
+    """Deterministic Reporting API data and the faults to inject.
+
+    The view has ``packages`` datasets with RESOURCES_PER_PACKAGE
+    resources each, named as in benchmark.py, so that a loader pointed at
+    the mock can resolve the urls in a database filled by the benchmark.
+    On each of the last ``days`` days ``rows_per_day`` of their pages are
+    visited; the numbers depend only on ``seed`` and the day. Every metric
+    has the same value.
+
+    Data requests take ``latency`` seconds. A share ``error_rate`` of them,
+    and any beyond ``max_rate`` a second, fail with a rate limit 403.
+    Responses for ranges of more than ``sample_days`` days claim to contain
+    sampled data.
+    """
+
+    def __init__(self, packages=1000, rows_per_day=None, days=90, seed=0,
+                 latency=0, error_rate=0, max_rate=None, sample_days=None,
+                 path_prefix='/en', account_name='Mock account',
+                 account_id='1000', web_property_id='UA-1000-1',
+                 profile_id='2000'):
+        self.urls = ([path_prefix + package_url(i) for i in range(packages)] +
+                     [path_prefix + resource_url(i) for i in
+                      range(packages * RESOURCES_PER_PACKAGE)])
+        self.rows_per_day = min(rows_per_day or len(self.urls),
+                                len(self.urls))
+        self.first_date = datetime.date.today() - datetime.timedelta(days)
+        self.seed = seed
+        self.latency = latency
+        self.error_rate = error_rate
+        self.max_rate = max_rate
+        self.sample_days = sample_days
+        self.account_name = account_name
+        self.account_id = account_id
+        self.web_property_id = web_property_id
+        self.profile_id = profile_id
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.recent = []
+        self.results = OrderedDict()
+        self.stats = {'requests': 0, 'errors': 0, 'rows': 0}
+
+    def day(self, date):
+        """The (pagePath, count) visits of date"""
+        if date < self.first_date or date > datetime.date.today():
+            return []
+        rng = random.Random(self.seed * 1000003 + date.toordinal())
+        return [(self.urls[i], int(rng.paretovariate(1.2)))
+                for i in rng.sample(xrange(len(self.urls)),
+                                    self.rows_per_day)]
+
+    def check_quota(self):
+        with self.lock:
+            self.stats['requests'] += 1
+            now = time.time()
+            self.recent = [t for t in self.recent if t > now - 1]
+            limited = self.max_rate and len(self.recent) >= self.max_rate
+            self.recent.append(now)
+            if limited or self.random.random() < self.error_rate:
+                self.stats['errors'] += 1
+                raise ApiError(403, 'userRateLimitExceeded',
+                               'User Rate Limit Exceeded')
+
+    def _rows(self, start, end, dimensions, metrics, filters, sort):
+        """All rows of a query, sorted, computed once for all its pages"""
+        key = (start, end, dimensions, metrics, filters, sort)
+        with self.lock:
+            if key in self.results:
+                return self.results[key]
+        totals = OrderedDict()
+        date = start
+        while date <= end:
+            for path, count in self.day(date):
+                row = {'ga:date': date.strftime('%Y%m%d'), 'ga:pagePath': path}
+                if filters and not _matches(row, filters):
+                    continue
+                values = tuple(row[name] for name in dimensions)
+                totals[values] = totals.get(values, 0) + count
+            date += datetime.timedelta(1)
+        rows = [list(values) + [count] * len(metrics)
+                for values, count in totals.iteritems()]
+
+        columns = list(dimensions) + list(metrics)
+        # GA orders by the dimensions unless told otherwise
+        order = sort.split(',') if sort else list(dimensions)
+        for name in reversed(order):
+            descending = name.startswith('-')
+            name = name.lstrip('-')
+            if name not in columns:
+                raise ApiError(400, 'invalidParameter',
+                               'Sort key %s is not a dimension or metric '
+                               'of the query' % name)
+            i = columns.index(name)
+            rows.sort(key=lambda row: row[i], reverse=descending)
+        with self.lock:
+            self.results[key] = rows
+            while len(self.results) > 16:
+                self.results.popitem(last=False)
+        return rows
+
+    def data(self, params, url):
+        """data.ga.get: url is the request's url without the query"""
+        for name in ('ids', 'start-date', 'end-date', 'metrics'):
+            if not params.get(name):
+                raise ApiError(400, 'required', 'Required parameter: ' + name)
+        if params['ids'] != 'ga:' + self.profile_id:
+            raise ApiError(403, 'insufficientPermissions',
+                           'User does not have permission to access this '
+                           'profile.')
+        self.check_quota()
+        if self.latency:
+            time.sleep(self.latency)
+
+        start = _parse_date(params['start-date'])
+        end = _parse_date(params['end-date'])
+        if end < start:
+            raise ApiError(400, 'invalidParameter',
+                           'Start date must be before the end date')
+        dimensions = tuple(d for d in params.get('dimensions', '').split(',')
+                           if d)
+        for name in dimensions:
+            if name not in DIMENSIONS:
+                raise ApiError(400, 'invalidParameter',
+                               'Unknown dimension: ' + name)
+        metrics = tuple(params['metrics'].split(','))
+        start_index = int(params.get('start-index', 1))
+        max_results = min(int(params.get('max-results',
+                                         DEFAULT_MAX_RESULTS)),
+                          GA_MAX_RESULTS)
+        rows = self._rows(start, end, dimensions, metrics,
+                          params.get('filters'), params.get('sort'))
+        page = rows[start_index - 1:start_index - 1 + max_results]
+        with self.lock:
+            self.stats['rows'] += len(page)
+        sampled = (self.sample_days is not None and
+                   (end - start).days + 1 > self.sample_days)
+
+        link = url + '?' + urllib.urlencode(sorted(params.items()))
+        result = {
+            'kind': 'analytics#gaData',
+            'id': link,
+            'selfLink': link,
+            'query': dict(params, **{'start-index': start_index,
+                                     'max-results': max_results,
+                                     'metrics': list(metrics)}),
+            'itemsPerPage': max_results,
+            'totalResults': len(rows),
+            'profileInfo': {'profileId': self.profile_id,
+                            'accountId': self.account_id,
+                            'webPropertyId': self.web_property_id,
+                            'tableId': params['ids']},
+            'containsSampledData': sampled,
+            'columnHeaders': (
+                [{'name': name, 'columnType': 'DIMENSION',
+                  'dataType': 'STRING'} for name in dimensions] +
+                [{'name': name, 'columnType': 'METRIC',
+                  'dataType': 'INTEGER'} for name in metrics]),
+            'totalsForAllResults': dict(
+                (name, str(sum(row[-1] for row in rows)))
+                for name in metrics),
+        }
+        if sampled:
+            result['sampleSize'] = str(len(rows))
+            result['sampleSpace'] = str(len(rows) * 2)
+        if start_index - 1 + max_results < len(rows):
+            result['nextLink'] = url + '?' + urllib.urlencode(sorted(
+                dict(params,
+                     **{'start-index': start_index + max_results}).items()))
+        if page:
+            # GA returns every value as a string
+            result['rows'] = [[str(value) for value in row] for row in page]
+        return result
+
+    def management(self, kind, items):
+        return {'kind': 'analytics#' + kind, 'username': 'mock',
+                'totalResults': len(items), 'startIndex': 1,
+                'itemsPerPage': 1000, 'items': items}
+
+    def accounts(self):
+        return self.management('accounts', [{
+            'id': self.account_id, 'kind': 'analytics#account',
+            'name': self.account_name}])
+
+    def webproperties(self, account_id):
+        if account_id != self.account_id:
+            return self.management('webproperties', [])
+        return self.management('webproperties', [{
+            'id': self.web_property_id, 'kind': 'analytics#webproperty',
+            'accountId': self.account_id, 'name': 'Mock property'}])
+
+    def profiles(self, account_id, web_property_id):
+        if (account_id, web_property_id) != (self.account_id,
+                                             self.web_property_id):
+            return self.management('profiles', [])
+        return self.management('profiles', [{
+            'id': self.profile_id, 'kind': 'analytics#profile',
+            'accountId': self.account_id,
+            'webPropertyId': self.web_property_id, 'name': 'All Web Site Data'}])
+
+
+class ReportingAPIHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    routes = (
+        (re.compile('^%s$' % DISCOVERY_PATH), 'discovery'),
+        (re.compile(r'^/analytics/v3/management/accounts$'), 'accounts'),
+        (re.compile(r'^/analytics/v3/management/accounts/([^/]+)/'
+                    r'webproperties$'), 'webproperties'),
+        (re.compile(r'^/analytics/v3/management/accounts/([^/]+)/'
+                    r'webproperties/([^/]+)/profiles$'), 'profiles'),
+        (re.compile(r'^/analytics/v3/data/ga$'), 'data'),
+        (re.compile(r'^/stats$'), 'stats'),
+    )
+
+    def do_GET(self):
+        api = self.server.api
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        root_url = 'http://%s/' % self.headers.get(
+            'Host', '%s:%d' % self.server.server_address)
+        try:
+            for regex, name in self.routes:
+                match = regex.match(url.path)
+                if not match:
+                    continue
+                if name == 'discovery':
+                    return self.respond(200, discovery_document(root_url))
+                if name == 'data':
+                    return self.respond(200, api.data(
+                        params, root_url.rstrip('/') + url.path))
+                if name == 'stats':
+                    return self.respond(200, api.stats)
+                return self.respond(200, getattr(api, name)(*match.groups()))
+            raise ApiError(404, 'notFound', 'Not Found')
+        except ApiError, e:
+            self.respond(e.code, e.content())
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path == '/token':
+            return self.respond(200, {'access_token': 'mock-token',
+                                      'token_type': 'Bearer',
+                                      'expires_in': 3600})
+        self.respond(404, ApiError(404, 'notFound', 'Not Found').content())
+
+    def respond(self, code, content):
+        body = json.dumps(content)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingServer(SocketServer.ThreadingMixIn, ReusableServer):
+    daemon_threads = True
+
+
+def make_reporting_api(host='localhost', port=0, **options):
+    """A mock Reporting API server with MockReportingAPI options; its
+    url is ``server.url``."""
+    server = ThreadingServer((host, port), ReportingAPIHandler)
+    server.api = MockReportingAPI(**options)
+    server.url = 'http://%s:%d' % (host, server.server_address[1])
+    return server
+
+
+def run_reporting_api(host='localhost', port=0, **options):
+    """Start a mock Reporting API in a thread. Stop it with
+    ``shutdown()``."""
+    server = make_reporting_api(host, port, **options)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return server
+
+
+def write_credentials(filename, url):
+    """Write a service account key file whose tokens come from the mock
+    at url."""
+    import rsa
+    public_key, private_key = rsa.newkeys(1024)
+    with open(filename, 'w') as f:
+        json.dump({
+            'type': 'service_account',
+            'project_id': 'mock',
+            'private_key_id': 'mock',
+            'private_key': private_key.save_pkcs1(),
+            'client_email': 'loadtest@mock.iam.gserviceaccount.com',
+            'client_id': '1',
+            'auth_uri': url + '/auth',
+            'token_uri': url + '/token',
+        }, f, indent=2)
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage='%prog [options]', description=(
+        'Serve a mock Google Analytics Reporting API v3, e.g. to measure '
+        'loadanalytics without network access.'))
+    parser.add_option('--host', default='localhost')
+    parser.add_option('--port', type='int', default=6970)
+    parser.add_option('--packages', type='int', default=1000)
+    parser.add_option('--rows-per-day', dest='rows_per_day', type='int',
+                      help='visited pages a day (default: all)')
+    parser.add_option('--days', type='int', default=90,
+                      help='days back from today that have data')
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--latency', type='float', default=0,
+                      help='seconds each data request takes')
+    parser.add_option('--error-rate', dest='error_rate', type='float',
+                      default=0, help='share of requests failing with a 403')
+    parser.add_option('--max-rate', dest='max_rate', type='float',
+                      help='requests a second allowed before 403s')
+    parser.add_option('--sample-days', dest='sample_days', type='int',
+                      help='flag longer ranges as sampled')
+    parser.add_option('--credentials', default='mock-credentials.json',
+                      help='key file to write for loadanalytics')
+    options, args = parser.parse_args(args)
+
+    server = make_reporting_api(
+        options.host, options.port,
+        packages=options.packages, rows_per_day=options.rows_per_day,
+        days=options.days, seed=options.seed, latency=options.latency,
+        error_rate=options.error_rate, max_rate=options.max_rate,
+        sample_days=options.sample_days)
+    api, url = server.api, server.url
+    write_credentials(options.credentials, url)
+    print 'Serving the mock Reporting API on %s. Run loadanalytics with' % url
+    print '%s and these settings:\n' % options.credentials
+    print '    googleanalytics.api_discovery_url = %s%s' % (url, DISCOVERY_URL)
+    print '    googleanalytics.account = %s' % api.account_name
+    print '    googleanalytics.id = %s' % api.web_property_id
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print '\n%(requests)d requests, %(errors)d errors, %(rows)d rows' % \
+            api.stats
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+"""Names and urls of the synthetic datasets and resources shared by
+benchmark.py and mockgoogleanalytics.py.
+
+Only the standard library is imported here, so that the mock Reporting
+API can run without CKAN installed.
+"""
+import hashlib
+import uuid
+
+# as in ckanext.googleanalytics.commands, which needs CKAN to import
+PACKAGE_URL = '/dataset/'
+RESOURCES_PER_PACKAGE = 2
+
+
+def package_name(i):
+    return 'benchmark-dataset-%d' % i
+
+
+def resource_id(i):
+    return str(uuid.UUID(hashlib.md5('benchmark-resource-%d' % i)
+                         .hexdigest()))
+
+
+def package_url(i):
+    return PACKAGE_URL + package_name(i)
+
+
+def resource_url(i):
+    return '%s%s/resource/%s' % (PACKAGE_URL,
+                                 package_name(i // RESOURCES_PER_PACKAGE),
+                                 resource_id(i))
@@ -0,0 +1,53 @@
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from ckanext.googleanalytics.cache import ResponseCache, TTLCache
+
+
+class TestTTLCache(TestCase):
+    def test_expiry(self):
+        cache = TTLCache(ttl=0.05)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=60)
+        self.assertEquals(cache.get('a'), 1)
+        time.sleep(0.1)
+        self.assertEquals(cache.get('a'), None)
+        self.assertEquals(cache.get('b'), 2)
+
+    def test_least_recently_used_evicted(self):
+        cache = TTLCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEquals(cache.get('b', 'missing'), 'missing')
+        self.assertEquals(cache.get('a'), 1)
+        self.assertEquals(len(cache), 2)
+
+
+class TestResponseCache(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_shared_between_instances(self):
+        params = {'ids': 'ga:1', 'start_date': '2017-01-01', 'start_index': 1}
+        ResponseCache(self.path).set(params, {'rows': [['a', '1']]}, ttl=None)
+        cache = ResponseCache(self.path)
+        self.assertEquals(cache.get(dict(params)), {'rows': [['a', '1']]})
+        self.assertEquals(cache.get(dict(params, start_index=10001)), None)
+        self.assertEquals((cache.hits, cache.misses), (1, 1))
+
+    def test_expiry(self):
+        cache = ResponseCache(self.path, ttl=0.05)
+        cache.set({'q': 1}, {'rows': []})
+        cache.set({'q': 2}, {'rows': []}, ttl=None)
+        cache.set({'q': 3}, {'rows': []}, ttl=0)
+        time.sleep(0.1)
+        self.assertEquals(cache.get({'q': 1}), None)
+        self.assertEquals(cache.get({'q': 2}), {'rows': []})
+        self.assertEquals(cache.get({'q': 3}), None)
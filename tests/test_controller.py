@@ -0,0 +1,143 @@
+import datetime
+from unittest import TestCase
+
+from ckanext.googleanalytics import cache, controller, dbutil, plugin
+from ckanext.googleanalytics.controller import GAController
+
+VERSION = '1500000000.500000'
+
+
+class MockModel(object):
+    def __init__(self, system_info):
+        self.system_info = system_info
+
+    def get_system_info(self, key, default=None):
+        return self.system_info.get(key, default)
+
+    def set_system_info(self, key, value):
+        self.system_info[key] = value
+
+
+class MockContext(object):
+    def __init__(self, user=''):
+        self.user = user
+
+
+class MockRequest(object):
+    def __init__(self, headers=None, if_modified_since=None):
+        self.headers = headers or {}
+        self.if_modified_since = if_modified_since
+        self.environ = {'CKAN_LANG': 'en'}
+
+
+class MockResponse(object):
+    def __init__(self):
+        self.headers = {}
+        self.status_int = 200
+        self.last_modified = None
+
+
+class TestView(TestCase):
+    def setUp(self):
+        self.originals = dict(
+            (name, getattr(controller, name))
+            for name in ('c', 'request', 'response', 'render'))
+        self.original_model = dbutil.model
+        self.original_top = (dbutil.get_top_package_rows,
+                             dbutil.get_top_resource_rows)
+        self.original_cache = plugin.GoogleAnalyticsPlugin.stats_cache
+        self.original_ttl = plugin.STATS_VERSION_TTL
+
+        dbutil.model = MockModel({dbutil.STATS_VERSION_KEY: VERSION})
+        self.queries = []
+        dbutil.get_top_package_rows = self._top_package_rows
+        dbutil.get_top_resource_rows = lambda limit: []
+        plugin.GoogleAnalyticsPlugin.stats_cache = cache.TTLCache()
+        # check for a new version on every request
+        plugin.STATS_VERSION_TTL = -1
+        self.rendered = []
+        controller.render = self._render
+
+    def tearDown(self):
+        for name, value in self.originals.items():
+            setattr(controller, name, value)
+        dbutil.model = self.original_model
+        (dbutil.get_top_package_rows,
+         dbutil.get_top_resource_rows) = self.original_top
+        plugin.GoogleAnalyticsPlugin.stats_cache = self.original_cache
+        plugin.STATS_VERSION_TTL = self.original_ttl
+
+    def _top_package_rows(self, limit):
+        self.queries.append(limit)
+        return [('id', 'name', 'Title', 1, 2)]
+
+    def _render(self, template):
+        self.rendered.append(controller.c.user)
+        return 'summary for %r' % controller.c.user
+
+    def _view(self, user='', **headers):
+        controller.c = MockContext(user)
+        controller.request = MockRequest(**headers)
+        controller.response = MockResponse()
+        page = GAController().view()
+        return page, controller.response
+
+    def test_matching_etag_is_not_modified(self):
+        page, response = self._view()
+        self.assertEquals(page, "summary for ''")
+        self.assertEquals(response.status_int, 200)
+        etag = response.headers['ETag']
+        self.assertEquals(response.last_modified, 1500000000)
+
+        page, response = self._view(headers={'If-None-Match': etag})
+        self.assertEquals((page, response.status_int), ('', 304))
+        page, response = self._view(
+            headers={'If-None-Match': '"other", %s' % etag})
+        self.assertEquals(response.status_int, 304)
+        page, response = self._view(
+            if_modified_since=datetime.datetime(2017, 7, 14, 2, 40))
+        self.assertEquals(response.status_int, 304)
+        # an older copy is sent the page again
+        page, response = self._view(
+            if_modified_since=datetime.datetime(2017, 7, 14, 2, 39))
+        self.assertEquals((page, response.status_int),
+                          ("summary for ''", 200))
+        self.assertEquals(self.rendered, [''])
+        self.assertEquals(len(self.queries), 1)
+
+    def test_new_stats_change_the_etag(self):
+        page, response = self._view()
+        etag = response.headers['ETag']
+
+        dbutil.bump_stats_version()
+        page, response = self._view(headers={'If-None-Match': etag})
+        self.assertEquals((page, response.status_int),
+                          ("summary for ''", 200))
+        self.assertNotEquals(response.headers['ETag'], etag)
+        self.assertTrue(response.last_modified >= 1500000000)
+        # the page and the top lists are not taken from the old version
+        self.assertEquals(self.rendered, ['', ''])
+        self.assertEquals(len(self.queries), 2)
+
+        page, response = self._view(
+            headers={'If-None-Match': response.headers['ETag']})
+        self.assertEquals(response.status_int, 304)
+
+    def test_logged_in_users_are_not_cached(self):
+        page, response = self._view()
+        etag = response.headers['ETag']
+
+        page, response = self._view('alice', headers={'If-None-Match': etag})
+        self.assertEquals((page, response.status_int),
+                          ("summary for 'alice'", 200))
+        self.assertFalse('ETag' in response.headers)
+        self.assertEquals(response.last_modified, None)
+        page, response = self._view('bob')
+        self.assertEquals(page, "summary for 'bob'")
+
+        # anonymous users still get their own cached page
+        page, response = self._view()
+        self.assertEquals(page, "summary for ''")
+        self.assertEquals(self.rendered, ['', 'alice', 'bob'])
+        # the top lists are shared, so are only queried once
+        self.assertEquals(len(self.queries), 1)
@@ -0,0 +1,52 @@
+from unittest import TestCase
+
+from ckanext.googleanalytics.eventfilter import ApiEventFilter
+
+
+class TestApiEventFilter(TestCase):
+    def test_from_config(self):
+        event_filter = ApiEventFilter.from_config({
+            'googleanalytics.api_events.deny': 'status_show, *_autocomplete',
+            'googleanalytics.api_events.sample_rates':
+                'package_show:0.1 resource_*:0',
+            'googleanalytics.api_events.sample_rate': '0.5',
+            'googleanalytics.api_events.ignore_user_agents':
+                'kube-probe, Harvester',
+        })
+        self.assertEquals(event_filter.rate('status_show'), 0)
+        self.assertEquals(event_filter.rate('tag_autocomplete'), 0)
+        self.assertEquals(event_filter.rate('package_show'), 0.1)
+        self.assertEquals(event_filter.rate('resource_show'), 0)
+        self.assertEquals(event_filter.rate('package_search'), 0.5)
+        assert not event_filter.accept('status_show')
+        assert not event_filter.accept('resource_show')
+
+    def test_allow(self):
+        event_filter = ApiEventFilter(allow=['package_*'])
+        assert event_filter.accept('package_search')
+        assert not event_filter.accept('user_list')
+
+    def test_ignore_user_agents(self):
+        event_filter = ApiEventFilter(ignore_user_agents=['harvester'])
+        assert event_filter.accept('package_show', 'Mozilla/5.0')
+        assert not event_filter.accept('package_show', 'CKAN Harvester/1.0')
+
+    def test_sampling(self):
+        event_filter = ApiEventFilter(sample_rate=0.25)
+        accepted = sum(event_filter.accept('package_show')
+                       for i in range(4000))
+        assert 800 < accepted < 1200, accepted
+
+    def test_invalid_config(self):
+        for key, value in [('sample_rates', 'package_show'),
+                           ('sample_rates', 'package_show:often'),
+                           ('sample_rates', ':0.5'),
+                           ('sample_rate', '2')]:
+            key = 'googleanalytics.api_events.' + key
+            try:
+                ApiEventFilter.from_config({key: value})
+            except ValueError, e:
+                assert key in str(e), str(e)
+                assert repr(value) in str(e), str(e)
+            else:
+                self.fail('%s = %s was accepted' % (key, value))
@@ -0,0 +1,119 @@
+from unittest import TestCase
+
+import jinja2
+
+from ckanext.googleanalytics import plugin
+from ckanext.googleanalytics.plugin import (
+    GoogleAnalyticsPlugin, HEADER_FIELDS_MARKER, HEADER_SNIPPET,
+    uses_request_globals)
+
+
+class MockUser(object):
+    def __init__(self, id):
+        self.id = id
+
+
+class MockContext(object):
+    def __init__(self, user=None):
+        self.user = user
+        self.userobj = user and MockUser(user + '-id')
+
+
+class MockRequest(object):
+    def __init__(self, lang):
+        self.environ = {'CKAN_LANG': lang}
+
+
+class TestHeader(TestCase):
+    def setUp(self):
+        self.original_c = plugin.c
+        self.original_request = plugin.request
+        plugin.request = MockRequest('en')
+        self.plugin = GoogleAnalyticsPlugin()
+        self.plugin.googleanalytics_id = 'UA-1'
+        self.plugin.googleanalytics_domain = 'auto'
+        self.plugin.googleanalytics_linked_domains = []
+        self.plugin.googleanalytics_fields = {}
+        self.plugin._header_fields = str({})
+        self.plugin._header_parts = {}
+        self.plugin._header_per_request = False
+        self.plugin.enable_user_id = True
+        self.rendered = []
+
+    def tearDown(self):
+        plugin.c = self.original_c
+        plugin.request = self.original_request
+
+    def _render_snippet(self, template):
+        def render_snippet(fields):
+            self.rendered.append(fields)
+            return template.replace('FIELDS', fields).replace(
+                'LANG', plugin.request.environ['CKAN_LANG'])
+        self.plugin._render_snippet = render_snippet
+
+    def _header(self, user=None, lang='en'):
+        plugin.c = MockContext(user)
+        plugin.request = MockRequest(lang)
+        return self.plugin.googleanalytics_header()
+
+    def test_user_id_does_not_leak(self):
+        self._render_snippet("ga('create', FIELDS);")
+        self.assertEquals(self._header('alice'),
+                          "ga('create', {'userId': 'alice-id'});")
+        self.assertEquals(self._header(), "ga('create', {});")
+        self.assertEquals(self._header('bob'),
+                          "ga('create', {'userId': 'bob-id'});")
+        self.assertEquals(self.plugin.googleanalytics_fields, {})
+        # rendered once, with the marker
+        self.assertEquals(self.rendered, [HEADER_FIELDS_MARKER])
+
+    def test_rendered_per_request_without_a_single_marker(self):
+        self._render_snippet("ga('create', FIELDS); // FIELDS")
+        self.assertEquals(self._header('alice'),
+                          "ga('create', {'userId': 'alice-id'}); "
+                          "// {'userId': 'alice-id'}")
+        self.assertEquals(self._header(), "ga('create', {}); // {}")
+        self.assertEquals(len(self.rendered), 3)
+
+    def test_rendered_once_per_language(self):
+        self._render_snippet("// LANG\nga('create', FIELDS);")
+        self.assertEquals(self._header('alice', 'de'),
+                          "// de\nga('create', {'userId': 'alice-id'});")
+        self.assertEquals(self._header(lang='fr'), "// fr\nga('create', {});")
+        self.assertEquals(self._header(lang='de'), "// de\nga('create', {});")
+        self.assertEquals(self.rendered, [HEADER_FIELDS_MARKER] * 2)
+
+    def test_rendered_per_request_when_the_template_uses_the_request(self):
+        self._render_snippet("// LANG\nga('create', FIELDS);")
+        self.plugin._header_per_request = None
+        self.plugin._header_uses_request = lambda: True
+        self.assertEquals(self._header('alice'),
+                          "// en\nga('create', {'userId': 'alice-id'});")
+        self.assertEquals(self._header(), "// en\nga('create', {});")
+        self.assertEquals(self.rendered,
+                          [str({'userId': 'alice-id'}), str({})])
+
+
+class TestUsesRequestGlobals(TestCase):
+    def _uses(self, header, **templates):
+        templates[HEADER_SNIPPET] = header
+        env = jinja2.Environment(loader=jinja2.DictLoader(templates))
+        return uses_request_globals(env, HEADER_SNIPPET)
+
+    def test_fields_and_translations_only(self):
+        assert not self._uses(
+            "{{ _('Tracking') }} ga('create', '{{ googleanalytics_id }}', "
+            "{{ googleanalytics_fields|safe }});")
+
+    def test_user(self):
+        assert self._uses("{% if c.user %}{{ googleanalytics_fields }}"
+                          "{% endif %}")
+
+    def test_helper_in_an_included_template(self):
+        assert self._uses("{% include 'extra.html' %}",
+                          **{'extra.html': "{{ h.full_current_url() }}"})
+        assert not self._uses("{% include 'extra.html' %}",
+                              **{'extra.html': "{{ googleanalytics_id }}"})
+
+    def test_template_named_by_an_expression(self):
+        assert self._uses("{% include googleanalytics_id ~ '.html' %}")
@@ -0,0 +1,129 @@
+import datetime
+import threading
+import time
+from unittest import TestCase
+
+from ckanext.googleanalytics import commands
+from ckanext.googleanalytics.commands import LoadAnalytics
+from ckanext.googleanalytics.ratelimit import RateLimiter
+
+
+class MockRequest(object):
+    def __init__(self, params):
+        self.params = params
+
+    def execute(self, http=None):
+        return {'rows': [[self.params['start_date'], http]]}
+
+
+class MockService(object):
+    def data(self):
+        return self
+
+    def ga(self):
+        return self
+
+    def get(self, **params):
+        return MockRequest(params)
+
+
+class MockLoadAnalytics(LoadAnalytics):
+    def __init__(self):
+        super(MockLoadAnalytics, self).__init__('loadanalytics')
+        self.service = MockService()
+        self.rate_limiter = RateLimiter(1000, 100)
+        self.response_cache = None
+        self.https = []
+
+    def _authorized_http(self):
+        http = object()
+        self.https.append(http)
+        return http
+
+    def iter_ga_pages(self, start_date, end_date):
+        for page in range(3):
+            # later ranges finish first
+            time.sleep(0.01 * (5 - start_date))
+            if start_date == 3 and page == 1:
+                raise ValueError('range 3 failed')
+            results = self._ga_get(start_date=start_date)
+            yield [(start_date, page, results['rows'][0][1],
+                    threading.current_thread())]
+
+
+class TestPrefetch(TestCase):
+    def test_ranges_are_returned_in_order(self):
+        command = MockLoadAnalytics()
+        ranges = [[day] for day in range(3)]
+        results = [(days, list(pages))
+                   for days, pages in command._prefetch(ranges, 3)]
+        self.assertEquals([r[0] for r in results], [[0], [1], [2]])
+        pages = [page[0] for r in results for page in r[1]]
+        self.assertEquals([page[:2] for page in pages],
+                          [(day, page) for day in range(3)
+                           for page in range(3)])
+        # every worker thread queried Google with its own http object
+        https = dict((page[3], page[2]) for page in pages)
+        assert len(https) > 1
+        self.assertEquals(len(set(https.values())), len(https))
+
+    def test_errors_are_raised_in_order(self):
+        command = MockLoadAnalytics()
+        seen = []
+        try:
+            for days, pages in command._prefetch(
+                    [[day] for day in range(5)], 2):
+                for page in pages:
+                    seen.append(page[0][:2])
+        except ValueError:
+            pass
+        else:
+            self.fail('the error of range 3 was not raised')
+        self.assertEquals(seen, [(day, page) for day in range(3)
+                                 for page in range(3)] + [(3, 0)])
+
+
+class MockOptions(object):
+    workers = 1
+    range_days = 2
+
+
+class TestBulkImport(TestCase):
+    def setUp(self):
+        self.original = (commands.dbutil.missing_tables,
+                         commands.dbutil.get_sync_state)
+
+    def tearDown(self):
+        (commands.dbutil.missing_tables,
+         commands.dbutil.get_sync_state) = self.original
+
+    def test_resume_reloads_days_that_are_not_final(self):
+        today = datetime.datetime.combine(datetime.date.today(),
+                                          datetime.time())
+        days = [today - datetime.timedelta(n) for n in range(6, -1, -1)]
+        state = {days[0].date(): {'rows': 5, 'final': True},
+                 days[1].date(): {'rows': 5, 'final': False},
+                 days[2].date(): {'rows': 5, 'final': True},
+                 days[3].date(): {'rows': 5, 'final': True}}
+        commands.dbutil.missing_tables = lambda: []
+        commands.dbutil.get_sync_state = lambda profile_id: state
+
+        command = MockLoadAnalytics()
+        command.args = ['credentials.json', 'internal']
+        command.profile_id = '1'
+        command.options = MockOptions()
+        queried = []
+        saved = []
+
+        def iter_ga_pages(start_date, end_date):
+            queried.append((start_date, end_date))
+            return iter([])
+        command.iter_ga_pages = iter_ga_pages
+        command.internal_save = lambda rows, day: saved.append(day) or 0
+        command.bulk_import()
+
+        # the final days 0, 2 and 3 are skipped, day 1 is loaded again
+        # from the start and the rest in ranges of two consecutive days
+        self.assertEquals(queried, [(days[1], days[1]), (days[4], days[5]),
+                                    (days[6], days[6])])
+        self.assertEquals(saved, [days[1], days[4], days[5], days[6]])
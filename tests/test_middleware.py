@@ -0,0 +1,73 @@
+from unittest import TestCase
+
+from ckanext.googleanalytics.eventfilter import ApiEventFilter
+from ckanext.googleanalytics.middleware import AnalyticsMiddleware
+from ckanext.googleanalytics.plugin import GoogleAnalyticsPlugin
+
+
+class MockSender(object):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, data_dict):
+        self.sent.append(data_dict)
+
+
+def app(environ, start_response):
+    start_response('200 OK', [])
+    return ['body']
+
+
+class TestAnalyticsMiddleware(TestCase):
+    def setUp(self):
+        self.sender = MockSender()
+        self.original = (GoogleAnalyticsPlugin.analytics_sender,
+                         GoogleAnalyticsPlugin.api_event_filter)
+        GoogleAnalyticsPlugin.analytics_sender = self.sender
+        GoogleAnalyticsPlugin.api_event_filter = ApiEventFilter(
+            deny=['status_show'])
+        self.middleware = AnalyticsMiddleware(app, 'UA-1')
+
+    def tearDown(self):
+        (GoogleAnalyticsPlugin.analytics_sender,
+         GoogleAnalyticsPlugin.api_event_filter) = self.original
+
+    def _get(self, match, query_string=''):
+        environ = {'wsgiorg.routing_args': ((), match),
+                   'QUERY_STRING': query_string,
+                   'PATH_INFO': '/api/3/action/x',
+                   'HTTP_HOST': 'example.com',
+                   'REMOTE_USER': 'tester'}
+        response = self.middleware(environ, lambda status, headers: None)
+        self.assertEquals(list(response), ['body'])
+        # nothing is sent before the response is finished
+        self.assertEquals(self.sender.sent, [])
+        response.close()
+        return self.sender.sent
+
+    def test_action(self):
+        sent = self._get({'controller': 'api', 'action': 'action',
+                          'logic_function': 'package_search'}, 'q=water')
+        self.assertEquals(len(sent), 1)
+        self.assertEquals(sent[0]['ea'], 'package_search')
+        self.assertEquals(sent[0]['el'], 'water')
+        self.assertEquals(sent[0]['ec'], 'CKAN API Request')
+
+    def test_rest(self):
+        sent = self._get({'controller': 'api', 'action': 'show',
+                          'register': 'package', 'id': 'abc'})
+        self.assertEquals(sent[0]['ea'], 'packageshow')
+        self.assertEquals(sent[0]['el'], 'abc')
+
+    def test_resource_download(self):
+        sent = self._get({'controller': 'package',
+                          'action': 'resource_download',
+                          'resource_id': 'r1'})
+        self.assertEquals(sent[0]['ea'], 'ResourceDownload')
+        self.assertEquals(sent[0]['el'], 'r1')
+
+    def test_filtered_and_untracked(self):
+        self.assertEquals(self._get({'controller': 'api', 'action': 'action',
+                                     'logic_function': 'status_show'}), [])
+        self.assertEquals(self._get({'controller': 'package',
+                                     'action': 'read'}), [])
@@ -0,0 +1,147 @@
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import urllib
+import urllib2
+from unittest import SkipTest, TestCase
+
+from mockgoogleanalytics import (DISCOVERY_URL, run_reporting_api,
+                                 write_credentials)
+
+
+class TestMockReportingAPI(TestCase):
+    def setUp(self):
+        self.server = run_reporting_api(packages=10, rows_per_day=20,
+                                        sample_days=7)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _get(self, path, **params):
+        url = self.server.url + path
+        if params:
+            url += '?' + urllib.urlencode(params)
+        try:
+            return 200, json.load(urllib2.urlopen(url))
+        except urllib2.HTTPError, e:
+            return e.code, json.load(e)
+
+    def _data(self, **params):
+        params.setdefault('ids', 'ga:2000')
+        params.setdefault('metrics', 'ga:uniquePageviews')
+        params.setdefault('start-date', '7daysAgo')
+        params.setdefault('end-date', 'yesterday')
+        return self._get('/analytics/v3/data/ga', **params)
+
+    def test_profiles(self):
+        code, accounts = self._get('/analytics/v3/management/accounts')
+        self.assertEquals(accounts['items'][0]['id'], '1000')
+        code, profiles = self._get('/analytics/v3/management/accounts/1000/'
+                                   'webproperties/UA-1000-1/profiles')
+        self.assertEquals(profiles['items'][0]['id'], '2000')
+
+    def test_pagination(self):
+        code, everything = self._data(dimensions='ga:date,ga:pagePath')
+        self.assertEquals(everything['totalResults'], 7 * 20)
+        self.assertFalse(everything['containsSampledData'])
+
+        params = {'dimensions': 'ga:date,ga:pagePath',
+                  'filters': 'ga:pagePath=~/resource/',
+                  'sort': 'ga:date,-ga:uniquePageviews,ga:pagePath',
+                  'max-results': 25}
+        rows = []
+        start_index = 1
+        while True:
+            code, page = self._data(**dict(params, **{
+                'start-index': start_index}))
+            rows.extend(page['rows'])
+            if 'nextLink' not in page:
+                break
+            start_index += 25
+        self.assertEquals(len(rows), page['totalResults'])
+        assert all('/resource/' in row[1] for row in rows)
+        self.assertEquals(rows, sorted(
+            rows, key=lambda row: (row[0], -int(row[2]), row[1])))
+        # the same query gives the same numbers
+        code, again = self._data(**dict(params, **{'max-results': 1000}))
+        self.assertEquals(again['rows'], rows)
+
+    def test_sampled(self):
+        code, results = self._data(**{'start-date': '30daysAgo'})
+        self.assertTrue(results['containsSampledData'])
+
+    def test_rate_limit(self):
+        self.server.api.error_rate = 1
+        code, results = self._data()
+        self.assertEquals(code, 403)
+        self.assertEquals(results['error']['errors'][0]['reason'],
+                          'userRateLimitExceeded')
+
+
+class TestLoadAnalyticsWithMock(TestCase):
+    """Drives the loader's API calls through apiclient against the mock"""
+    settings = {'googleanalytics.account': 'Mock account',
+                'googleanalytics.id': 'UA-1000-1'}
+
+    def setUp(self):
+        # unlike the tests above, these need CKAN and the Google client
+        try:
+            from pylons import config
+            from ckanext.googleanalytics import ga_auth
+            from ckanext.googleanalytics.commands import LoadAnalytics
+            from ckanext.googleanalytics.ratelimit import RateLimiter
+        except ImportError, e:
+            raise SkipTest(str(e))
+        self.config = config
+        self.ga_auth = ga_auth
+        self.server = run_reporting_api(packages=10, rows_per_day=20)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.credentials = os.path.join(self.tmp_dir, 'credentials.json')
+        write_credentials(self.credentials, self.server.url)
+        settings = dict(self.settings, **{
+            'googleanalytics.api_discovery_url':
+                self.server.url + DISCOVERY_URL})
+        self.saved = dict((key, config.get(key)) for key in settings)
+        config.update(settings)
+
+        self.command = LoadAnalytics('loadanalytics')
+        self.command.args = [self.credentials]
+        self.command.resource_url_tag = '/resource/'
+        self.command.rate_limiter = RateLimiter(1000, 100)
+        self.command.response_cache = None
+
+    def tearDown(self):
+        for key, value in self.saved.items():
+            if value is None:
+                self.config.pop(key, None)
+            else:
+                self.config[key] = value
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_load(self):
+        service = self.ga_auth.init_service(self.credentials)
+        self.assertEquals(self.ga_auth.get_profile_id(service), '2000')
+
+        self.command.service = service
+        self.command.profile_id = '2000'
+        end = datetime.date.today() - datetime.timedelta(1)
+        start = end - datetime.timedelta(2)
+        rows = []
+        for page in self.command.iter_ga_pages(start, end):
+            rows.extend(page)
+
+        expected = []
+        day = start
+        while day <= end:
+            expected.extend((day.strftime('%Y%m%d'), url[len('/en'):], count)
+                            for url, count in self.server.api.day(day))
+            day += datetime.timedelta(1)
+        self.assertEquals(len(rows), 3 * 20)
+        self.assertEquals(sorted(rows), sorted(expected))
+        self.assertEquals([row[0] for row in rows],
+                          sorted(row[0] for row in rows))
@@ -0,0 +1,70 @@
+import json
+import time
+from unittest import TestCase
+
+from ckanext.googleanalytics.ratelimit import (
+    TokenBucket, RateLimiter, is_retryable)
+
+
+class MockResponse(dict):
+    def __init__(self, status):
+        self.status = status
+
+
+class MockHttpError(Exception):
+    def __init__(self, status, reason=None):
+        self.resp = MockResponse(status)
+        self.content = json.dumps(
+            {'error': {'errors': [{'reason': reason}]}})
+
+
+class TestTokenBucket(TestCase):
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(20, burst=3)
+        started = time.time()
+        waits = [bucket.acquire() for i in range(5)]
+        self.assertEquals(waits[:3], [0, 0, 0])
+        assert waits[3] > 0
+        assert time.time() - started >= 0.09
+        assert bucket.waited > 0
+
+    def test_slow_down_and_recover(self):
+        bucket = TokenBucket(16)
+        bucket.slow_down()
+        self.assertEquals(bucket.rate, 8)
+        for i in range(10):
+            bucket.speed_up()
+        self.assertEquals(bucket.rate, 16)
+
+
+class TestRateLimiter(TestCase):
+    def test_is_retryable(self):
+        assert is_retryable(MockHttpError(503))
+        assert is_retryable(MockHttpError(429))
+        assert is_retryable(MockHttpError(403, 'userRateLimitExceeded'))
+        assert not is_retryable(MockHttpError(403, 'insufficientPermissions'))
+        assert not is_retryable(MockHttpError(400))
+        assert not is_retryable(ValueError())
+
+    def test_retries_with_backoff(self):
+        limiter = RateLimiter(100, burst=10, retries=3, backoff=0.01)
+        errors = [MockHttpError(403, 'rateLimitExceeded'), MockHttpError(500)]
+
+        def execute():
+            if errors:
+                raise errors.pop(0)
+            return {'rows': []}
+
+        self.assertEquals(limiter.call(execute), {'rows': []})
+        self.assertEquals(limiter.bucket.rate, 50 + 100 / 16.0)
+
+    def test_gives_up(self):
+        limiter = RateLimiter(100, retries=2, backoff=0.01)
+        calls = []
+
+        def execute():
+            calls.append(1)
+            raise MockHttpError(500)
+
+        self.assertRaises(MockHttpError, limiter.call, execute)
+        self.assertEquals(len(calls), 3)
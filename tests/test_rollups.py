@@ -0,0 +1,86 @@
+import datetime
+from unittest import SkipTest, TestCase
+
+from sqlalchemy.sql import text
+import ckan.model as model
+
+from ckanext.googleanalytics import dbutil
+from ckanext.googleanalytics.dbutil import _rollup_ranges
+
+D = datetime.date
+
+
+class TestRollupRanges(TestCase):
+    def test_coarsest_rollups_cover_the_range(self):
+        self.assertEquals(_rollup_ranges(D(2016, 12, 28), D(2018, 1, 9)), [
+            ('tracking_summary', D(2016, 12, 28), D(2016, 12, 31)),
+            ('tracking_summary_monthly', D(2017, 1, 1), D(2017, 12, 1)),
+            ('tracking_summary_weekly', D(2018, 1, 1), D(2018, 1, 1)),
+            ('tracking_summary', D(2018, 1, 8), D(2018, 1, 9)),
+        ])
+
+    def test_short_range_reads_days(self):
+        self.assertEquals(_rollup_ranges(D(2017, 3, 1), D(2017, 3, 3)), [
+            ('tracking_summary', D(2017, 3, 1), D(2017, 3, 3)),
+        ])
+
+
+class TestUpdateRollups(TestCase):
+    """Runs the rollup SQL, so needs CKAN's PostgreSQL test database"""
+    rows = [
+        ('/dataset/rollup-test', 3, D(2017, 3, 6), 'page', 'rollup-test-a'),
+        # the dataset was renamed, so its old url was not found this day
+        ('/dataset/rollup-test', 4, D(2017, 3, 7), 'page',
+         dbutil.PACKAGE_NOT_FOUND),
+        ('/dataset/rollup-test/resource/r', 5, D(2017, 3, 7), 'resource',
+         None),
+        ('/dataset/rollup-test', 2, D(2017, 3, 20), 'page', 'rollup-test-a'),
+    ]
+
+    def setUp(self):
+        if model.meta.engine.dialect.name != 'postgresql':
+            raise SkipTest('the rollups need PostgreSQL')
+        dbutil.init_tables()
+        self._load(self.rows)
+
+    def tearDown(self):
+        self._load([])
+
+    def _load(self, rows):
+        connection = model.meta.engine.connect()
+        trans = connection.begin()
+        connection.execute("DELETE FROM tracking_summary "
+                           "WHERE url LIKE '/dataset/rollup-test%%'")
+        dbutil.insert_tracking_summary(connection, rows)
+        for day in set(row[2] for row in self.rows):
+            dbutil.update_rollups(connection, day)
+        trans.commit()
+        connection.close()
+        model.Session.remove()
+
+    def _daily_counts(self, start_date, end_date, key):
+        return dict(model.Session.connection().execute(
+            text('''SELECT {key}, sum(count) FROM tracking_summary
+                    WHERE tracking_date BETWEEN :start AND :end
+                    AND {key} IS NOT NULL AND {key} != :not_found
+                    GROUP BY {key}'''.format(key=key)),
+            start=start_date, end=end_date,
+            not_found=dbutil.PACKAGE_NOT_FOUND).fetchall())
+
+    def test_rollups_agree_with_the_daily_counts(self):
+        # a whole month, a whole week, and days either side of a week
+        for start_date, end_date in [(D(2017, 3, 1), D(2017, 3, 31)),
+                                     (D(2017, 3, 6), D(2017, 3, 12)),
+                                     (D(2017, 3, 5), D(2017, 3, 21))]:
+            for key in ('package_id', 'url'):
+                counts = dict(dbutil.get_visit_counts(start_date, end_date,
+                                                      key))
+                self.assertEquals(
+                    counts, self._daily_counts(start_date, end_date, key))
+        counts = dict(dbutil.get_visit_counts(D(2017, 3, 1), D(2017, 3, 31)))
+        self.assertEquals(counts['rollup-test-a'], 5)
+        # the pages of unknown datasets are not a dataset
+        assert dbutil.PACKAGE_NOT_FOUND not in counts
+        counts = dict(dbutil.get_visit_counts(D(2017, 3, 1), D(2017, 3, 31),
+                                              'url', 'page'))
+        self.assertEquals(counts['/dataset/rollup-test'], 9)
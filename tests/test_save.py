@@ -0,0 +1,201 @@
+import datetime
+from unittest import SkipTest, TestCase
+
+from sqlalchemy.sql import text
+import ckan.model as model
+
+from ckanext.googleanalytics import commands, dbutil
+from ckanext.googleanalytics.commands import LoadAnalytics
+
+D = datetime.date
+
+PACKAGES = [('save-test-a-id', 'save-test-a', True, 'active'),
+            ('save-test-b-id', 'save-test-b', True, 'active'),
+            ('save-test-private-id', 'save-test-private', False, 'active'),
+            ('save-test-deleted-id', 'save-test-deleted', True, 'deleted')]
+RESOURCES = [('save-test-r1', 'save-test-a-id'),
+             ('save-test-r2', 'save-test-b-id'),
+             ('save-test-r3', 'save-test-private-id')]
+PATTERN = '%save-test%'
+
+
+class DatabaseTestCase(TestCase):
+    """Saves to CKAN's test database: test datasets and resources, and
+    everything saved for them, are removed again afterwards"""
+    dialects = ('postgresql', 'sqlite')
+
+    def setUp(self):
+        if model.meta.engine.dialect.name not in self.dialects:
+            raise SkipTest('needs %s' % ' or '.join(self.dialects))
+        dbutil.init_tables()
+        self._clean()
+        now = datetime.datetime.now()
+        connection = model.meta.engine.connect()
+        trans = connection.begin()
+        connection.execute(model.package_table.insert(), [
+            {'id': id, 'name': name, 'title': name.title(), 'type': 'dataset',
+             'state': state, 'private': not public,
+             'metadata_created': now, 'metadata_modified': now}
+            for id, name, public, state in PACKAGES])
+        connection.execute(model.resource_table.insert(), [
+            {'id': id, 'package_id': package_id, 'format': 'CSV',
+             'url': 'http://example.com/%s.csv' % id, 'state': 'active',
+             'position': 0}
+            for id, package_id in RESOURCES])
+        trans.commit()
+        connection.close()
+        self.command = LoadAnalytics('loadanalytics')
+        self.command.profile_id = 'save-test'
+        self.command.resource_url_tag = commands.DEFAULT_RESOURCE_URL_TAG
+        self.chunk_size = commands.SAVE_CHUNK_SIZE
+
+    def tearDown(self):
+        commands.SAVE_CHUNK_SIZE = self.chunk_size
+        self._clean()
+
+    def _clean(self):
+        model.Session.remove()
+        connection = model.meta.engine.connect()
+        trans = connection.begin()
+        for sql in ['DELETE FROM tracking_summary WHERE url LIKE :pattern',
+                    'DELETE FROM package_stats WHERE package_id LIKE :pattern',
+                    'DELETE FROM resource_stats '
+                    'WHERE resource_id LIKE :pattern',
+                    'DELETE FROM %s WHERE profile_id LIKE :pattern'
+                    % dbutil.SYNC_TABLE,
+                    'DELETE FROM resource WHERE id LIKE :pattern',
+                    'DELETE FROM package WHERE id LIKE :pattern']:
+            connection.execute(text(sql), pattern=PATTERN)
+        trans.commit()
+        connection.close()
+
+    def _tracking_rows(self, day):
+        return sorted(tuple(row) for row in model.meta.engine.execute(
+            text('''SELECT url, count, tracking_type, package_id
+                    FROM tracking_summary
+                    WHERE url LIKE :pattern
+                    AND tracking_date = :day'''),
+            pattern=PATTERN, day=day))
+
+
+class TestInsertTrackingSummary(DatabaseTestCase):
+    def test_insert(self):
+        # COPY on PostgreSQL, an executemany elsewhere
+        rows = [('/dataset/save-test-a', 3, D(2017, 3, 6), 'page',
+                 'save-test-a-id'),
+                (u'/dataset/save-test-\xe9\t\\n', 1, D(2017, 3, 6), 'page',
+                 dbutil.PACKAGE_NOT_FOUND),
+                ('/dataset/save-test-a/resource/save-test-r1', 2,
+                 D(2017, 3, 6), 'resource', None)]
+        connection = model.meta.engine.connect()
+        trans = connection.begin()
+        dbutil.insert_tracking_summary(connection, rows)
+        trans.commit()
+        connection.close()
+        self.assertEquals(self._tracking_rows(D(2017, 3, 6)), sorted(
+            (url, count, tracking_type, package_id)
+            for url, count, day, tracking_type, package_id in rows))
+
+
+class TestInternalSave(DatabaseTestCase):
+    dialects = ('postgresql',)
+
+    def test_save(self):
+        # a chunk at a time, so that the same url arrives in two chunks
+        commands.SAVE_CHUNK_SIZE = 2
+        day = datetime.datetime(2017, 3, 6)
+        saved = self.command.internal_save([
+            ('/dataset/save-test-a', 3),
+            ('/dataset/save-test-b', 1),
+            ('/dataset/edit/save-test-a', 2),
+            ('/dataset/save-test-gone', 4),
+            ('/dataset/save-test-a/resource/save-test-r1', 5),
+            ('/dataset/save-test-a', 7),
+        ], day)
+        self.assertEquals(saved, 6)
+        self.assertEquals(self._tracking_rows(day.date()), sorted([
+            ('/dataset/save-test-a', 10, 'page', 'save-test-a-id'),
+            ('/dataset/edit/save-test-a', 2, 'page', 'save-test-a-id'),
+            ('/dataset/save-test-b', 1, 'page', 'save-test-b-id'),
+            ('/dataset/save-test-gone', 4, 'page', dbutil.PACKAGE_NOT_FOUND),
+            ('/dataset/save-test-a/resource/save-test-r1', 5, 'resource',
+             None),
+        ]))
+        totals = dict(model.meta.engine.execute(
+            text('''SELECT url, running_total FROM tracking_summary
+                    WHERE url LIKE :pattern'''),
+            pattern=PATTERN).fetchall())
+        # the dataset's rows of the day, then the row's own count
+        self.assertEquals(totals['/dataset/save-test-a'], 12 + 10)
+        self.assertEquals(totals['/dataset/edit/save-test-a'], 12 + 2)
+        self.assertEquals(totals['/dataset/save-test-gone'], 0)
+        self.assertEquals(dbutil.get_sync_state('save-test'),
+                          {day.date(): {'rows': 6, 'final': True}})
+
+        # loading the day again replaces its rows
+        self.command.internal_save([('/dataset/save-test-b', 9)], day)
+        self.assertEquals(self._tracking_rows(day.date()), [
+            ('/dataset/save-test-b', 9, 'page', 'save-test-b-id')])
+
+
+class TestSaveGaData(DatabaseTestCase):
+    def _stats(self, table, id_col):
+        return dict((row[0], tuple(row[1:])) for row in
+                    model.meta.engine.execute(text(
+                        '''SELECT {id_col}, visits_recently, visits_ever
+                           FROM {table} WHERE {id_col} LIKE :pattern'''
+                        .format(table=table, id_col=id_col)),
+                        pattern=PATTERN))
+
+    def test_save_and_update(self):
+        commands.SAVE_CHUNK_SIZE = 2
+        resource_url = '/dataset/save-test-a/resource/save-test-r1'
+        self.command.save_ga_data({
+            '/dataset/save-test-a': {'recent': 3, 'ever': 10},
+            '/dataset/save-test-b': {'recent': 1, 'ever': 1},
+            '/dataset/save-test-gone': {'recent': 4, 'ever': 4},
+            '/dataset/edit/save-test-a': {'recent': 2, 'ever': 2},
+            resource_url: {'recent': 5, 'ever': 6},
+            '/dataset/save-test-a/resource/save-test-gone': {'recent': 1,
+                                                             'ever': 1},
+        })
+        # the second run updates the rows of the first
+        self.command.save_ga_data({
+            '/dataset/save-test-a': {'recent': 4, 'ever': 11},
+            resource_url: {'recent': 7, 'ever': 8},
+        })
+        self.assertEquals(self._stats('package_stats', 'package_id'), {
+            'save-test-a-id': (4, 11), 'save-test-b-id': (1, 1)})
+        self.assertEquals(self._stats('resource_stats', 'resource_id'), {
+            'save-test-r1': (7, 8)})
+
+    def test_top_lists_leave_out_private_and_deleted_datasets(self):
+        dbutil.update_package_visits_many([
+            ('save-test-a-id', 3, 10), ('save-test-b-id', 5, 5),
+            ('save-test-private-id', 100, 100),
+            ('save-test-deleted-id', 100, 100)])
+        dbutil.update_resource_visits_many([
+            ('save-test-r1', 2, 2), ('save-test-r2', 4, 4),
+            ('save-test-r3', 100, 100)])
+        model.Session.commit()
+
+        packages = [row for row in dbutil.get_top_package_rows(limit=1000)
+                    if row[0].startswith('save-test')]
+        self.assertEquals(packages, [
+            ('save-test-b-id', 'save-test-b', 'Save-Test-B', 5, 5),
+            ('save-test-a-id', 'save-test-a', 'Save-Test-A', 3, 10)])
+        self.assertEquals(
+            [(package.id, recently) for package, recently, ever
+             in dbutil.get_top_packages(limit=1000)
+             if package.id.startswith('save-test')],
+            [('save-test-b-id', 5), ('save-test-a-id', 3)])
+        resources = [row for row in dbutil.get_top_resource_rows(limit=1000)
+                     if row[0].startswith('save-test')]
+        self.assertEquals([(row[0], row[5], row[7]) for row in resources],
+                          [('save-test-r2', 'save-test-b', 4),
+                           ('save-test-r1', 'save-test-a', 2)])
+        self.assertEquals(
+            [resource.id for resource, recently, ever
+             in dbutil.get_top_resources(limit=1000)
+             if resource.id.startswith('save-test')],
+            ['save-test-r2', 'save-test-r1'])
@@ -0,0 +1,121 @@
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from ckanext.googleanalytics.plugin import (
+    AnalyticsQueue, AnalyticsSender, AnalyticsSpool, GoogleAnalyticsException,
+    OVERFLOW_DROP_NEWEST, OVERFLOW_DROP_OLDEST, OVERFLOW_BLOCK,
+    MAX_QUEUE_TIME)
+
+
+class TestAnalyticsQueue(TestCase):
+    def _fill(self, overflow):
+        queue = AnalyticsQueue(3, overflow, block_timeout=0.01)
+        accepted = [queue.offer(i) for i in range(5)]
+        return queue, accepted
+
+    def test_drop_newest(self):
+        queue, accepted = self._fill(OVERFLOW_DROP_NEWEST)
+        self.assertEquals(accepted, [True, True, True, False, False])
+        self.assertEquals(list(queue.queue), [0, 1, 2])
+        self.assertEquals(queue.stats()['dropped'], 2)
+
+    def test_drop_oldest(self):
+        queue, accepted = self._fill(OVERFLOW_DROP_OLDEST)
+        self.assertEquals(accepted, [True] * 5)
+        self.assertEquals(list(queue.queue), [2, 3, 4])
+        self.assertEquals(queue.stats()['dropped'], 2)
+        # dropped hits must not be left as unfinished tasks
+        self.assertEquals(queue.unfinished_tasks, 3)
+
+    def test_block(self):
+        queue, accepted = self._fill(OVERFLOW_BLOCK)
+        self.assertEquals(accepted, [True, True, True, False, False])
+        self.assertEquals(queue.stats()['dropped'], 2)
+
+    def test_unknown_policy(self):
+        self.assertRaises(GoogleAnalyticsException, AnalyticsQueue, 3, 'x')
+
+
+class MockResponse(object):
+    def raise_for_status(self):
+        pass
+
+
+class MockSession(object):
+    def __init__(self):
+        self.posted = []
+
+    def post(self, url, data=None, timeout=None):
+        self.posted.append(data)
+        return MockResponse()
+
+
+class TestAnalyticsSender(TestCase):
+    def test_threads_start_on_first_send(self):
+        sender = AnalyticsSender(AnalyticsQueue(), threads=2,
+                                 session=MockSession())
+        self.assertEquals(sender._pid, None)
+        sender.send({'el': 1})
+        self.assertEquals(sender._pid, os.getpid())
+
+    def test_flush_sends_partial_batches(self):
+        session = MockSession()
+        sender = AnalyticsSender(AnalyticsQueue(), threads=2,
+                                 session=session, batch_latency=60)
+        for i in range(3):
+            sender.send({'el': i})
+        started = time.time()
+        assert sender.flush(timeout=5)
+        assert time.time() - started < 5
+        hits = sorted(sum([data.split('\n') for data in session.posted], []))
+        self.assertEquals(hits, ['el=0', 'el=1', 'el=2'])
+
+
+class TestAnalyticsSpool(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.spool = AnalyticsSpool(os.path.join(self.dir, 'spool'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_replay_sends_spooled_hits_with_queue_time(self):
+        self.spool.append(['el=%s' % i for i in range(25)])
+        batches = []
+        sent = self.spool.replay(lambda batch: batches.append(batch) or True)
+        self.assertEquals(sent, 25)
+        self.assertEquals([len(b) for b in batches], [20, 5])
+        assert batches[0][0].startswith('el=0&qt=')
+        assert not self.spool.pending()
+
+    def test_failed_replay_keeps_hits(self):
+        self.spool.append(['el=%s' % i for i in range(25)])
+        sent = self.spool.replay(lambda batch: False)
+        self.assertEquals(sent, 0)
+        lines = open(self.spool.path).readlines()
+        self.assertEquals(len(lines), 25)
+        assert lines[0].endswith('\tel=0\n')
+
+    def test_expired_hits_are_discarded(self):
+        with open(self.spool.path, 'w') as f:
+            f.write('%d\tel=old\n' % (time.time() - MAX_QUEUE_TIME - 60))
+        batches = []
+        self.spool.replay(lambda batch: batches.append(batch) or True)
+        self.assertEquals(batches, [])
+        assert not self.spool.pending()
+
+    def test_malformed_lines_are_skipped(self):
+        self.spool.append(['el=0'])
+        with open(self.spool.path, 'a') as f:
+            f.write('garbage\n%del=torn\n' % time.time())
+        self.spool.append(['el=1'])
+        batches = []
+        sent = self.spool.replay(lambda batch: batches.append(batch) or True)
+        self.assertEquals(sent, 2)
+        self.assertEquals([d.split('&')[0] for d in batches[0]],
+                          ['el=0', 'el=1'])
+        assert not self.spool.pending()
+        self.assertEquals(os.listdir(self.dir), [])
@@ -0,0 +1,122 @@
+import datetime
+import random
+from unittest import SkipTest, TestCase
+
+import ckan.model as model
+
+from ckanext.googleanalytics import dbutil
+from ckanext.googleanalytics.commands import LoadAnalytics, PACKAGE_NOT_FOUND
+
+D = datetime.date
+
+# how the totals were computed before _update_totals, a row at a time
+OLD_TOTALS_SQL = ['''UPDATE tracking_summary t1
+                     SET running_total = (
+                        SELECT sum(count)
+                        FROM tracking_summary t2
+                        WHERE t1.url = t2.url
+                        AND t2.tracking_date <= t1.tracking_date
+                     ) + t1.count
+                     ,recent_views = (
+                        SELECT sum(count)
+                        FROM tracking_summary t2
+                        WHERE t1.url = t2.url
+                        AND t2.tracking_date <= t1.tracking_date
+                        AND t2.tracking_date >= t1.tracking_date - 14
+                     ) + t1.count
+                     WHERE t1.running_total = 0
+                     AND tracking_type = 'resource';''',
+                  '''UPDATE tracking_summary t1
+                     SET running_total = (
+                        SELECT sum(count)
+                        FROM tracking_summary t2
+                        WHERE t1.package_id = t2.package_id
+                        AND t2.tracking_date <= t1.tracking_date
+                     ) + t1.count
+                     ,recent_views = (
+                        SELECT sum(count)
+                        FROM tracking_summary t2
+                        WHERE t1.package_id = t2.package_id
+                        AND t2.tracking_date <= t1.tracking_date
+                        AND t2.tracking_date >= t1.tracking_date - 14
+                     ) + t1.count
+                     WHERE t1.running_total = 0 AND tracking_type = 'page'
+                     AND t1.package_id IS NOT NULL
+                     AND t1.package_id != '~~not~found~~';''']
+
+URLS = [('/dataset/totals-test-a', 'page', 'totals-test-a'),
+        ('/dataset/edit/totals-test-a', 'page', 'totals-test-a'),
+        ('/dataset/totals-test-b', 'page', 'totals-test-b'),
+        ('/dataset/totals-test-gone', 'page', PACKAGE_NOT_FOUND),
+        ('/dataset/totals-test-a/resource/r1', 'resource', None),
+        ('/dataset/totals-test-b/resource/r2', 'resource', None)]
+PATTERN = '/dataset/%totals-test%'
+
+
+class TestUpdateTotals(TestCase):
+    """Runs the totals SQL, so needs CKAN's PostgreSQL test database"""
+
+    def setUp(self):
+        if model.meta.engine.dialect.name != 'postgresql':
+            raise SkipTest('the totals need PostgreSQL')
+        dbutil.init_tables()
+        self.connection = model.meta.engine.connect()
+        self.trans = self.connection.begin()
+
+    def tearDown(self):
+        self.trans.rollback()
+        self.connection.close()
+
+    def _update_new(self):
+        command = LoadAnalytics('loadanalytics')
+        command._update_totals(self.connection, 'resource', 'url')
+        command._update_totals(self.connection, 'page', 'package_id',
+                               """AND package_id IS NOT NULL
+                                  AND package_id != '%s'""" %
+                               PACKAGE_NOT_FOUND)
+
+    def _update_old(self):
+        for sql in OLD_TOTALS_SQL:
+            self.connection.execute(sql)
+
+    def _load_days(self, days, rng):
+        self.connection.execute(
+            '''DELETE FROM tracking_summary WHERE tracking_date IN %(days)s
+               AND url LIKE %(pattern)s''', days=tuple(days), pattern=PATTERN)
+        dbutil.insert_tracking_summary(self.connection, [
+            (url, rng.randint(1, 50), day, tracking_type, package_id)
+            for day in days
+            for url, tracking_type, package_id in URLS
+            if rng.random() < 0.8])
+
+    def _run(self, update):
+        """Load days as loadanalytics would and return the test rows"""
+        self.connection.execute('DELETE FROM tracking_summary '
+                                'WHERE url LIKE %s', PATTERN)
+        rng = random.Random(0)
+        days = [D(2017, 1, 1) + datetime.timedelta(n) for n in range(40)]
+        # a first load of many days, then a day at a time, then recent
+        # days loaded again
+        self._load_days(days[:20], rng)
+        update()
+        for day in days[20:35]:
+            self._load_days([day], rng)
+            update()
+        for day in days[33:]:
+            self._load_days([day], rng)
+            update()
+        return self.connection.execute(
+            '''SELECT url, tracking_date, count, running_total, recent_views
+               FROM tracking_summary
+               WHERE url LIKE %s
+               ORDER BY url, tracking_date''', PATTERN).fetchall()
+
+    def test_same_totals_as_the_correlated_subqueries(self):
+        expected = self._run(self._update_old)
+        rows = self._run(self._update_new)
+        self.assertEquals(rows, expected)
+        assert any(row[3] > 300 for row in rows)
+        # rows of unknown datasets are not summed
+        self.assertEquals(
+            set(row[3] for row in rows
+                if row[0] == '/dataset/totals-test-gone'), set([0]))